@@ -2,16 +2,53 @@ import pyvista as pv
 import os
 import numpy as np
 import warnings
+from scipy.spatial import cKDTree
+from lacey_kernels import bin_and_count, count_cells
+
+# Compact mode sentinels: the class label of particles missing from a split
+# dictionary, and the mesh element of particles outside the mesh
+UNCLASSIFIED = 255
+OUT_OF_MESH = -1
 
 class ProcessSimulationTimestep():
 
-    def __init__(self, particles_file, cylinder_file):
+    def __init__(self, particles_file, cylinder_file=None, cylinder_bounds=None, compact=False):
 
         self.filepath = particles_file
         self.filename = os.path.basename(particles_file)
-        self.file_name_id = int(os.path.basename(particles_file).split("_")[1].split(".")[0])
+        self.file_name_id = int(os.path.basename(particles_file).split("_")[-1].split(".")[0])
         self.particles_file = pv.read(particles_file)
-        self.cylinder_file = pv.read(cylinder_file)
+
+        # In compact mode the particle positions, the other float columns of the
+        # dump (velocities, forces, radii, ...) and appended per particle columns
+        # are float32, class labels uint8 (UNCLASSIFIED for missing particles) and
+        # mesh elements int32 (OUT_OF_MESH outside the mesh) instead of float64
+        # with NaN. Particle ids keep their type, as float32 cannot hold every id
+        self.compact = compact
+        self.float_dtype = np.float32 if compact else np.float64
+
+        if compact and self.particles_file.n_points != 0:
+            self.particles_file.points = self.particles_file.points.astype(np.float32)
+
+            for name in self.particles_file.point_data.keys():
+                if name != "id" and self.particles_file[name].dtype == np.float64:
+                    self.particles_file[name] = self.particles_file[name].astype(np.float32)
+
+        # The vessel bounds are read from the cylinder mesh file of the dump, or
+        # given directly, e.g. computed from the vessel motion in vessel_motion.py
+        if cylinder_file is not None:
+            self.cylinder_file = pv.read(cylinder_file)
+            cylinder_bounds = self.cylinder_file.bounds
+
+        elif cylinder_bounds is None:
+            raise ValueError("Either cylinder_file or cylinder_bounds must be given")
+
+        self.cylinder_bounds = np.asarray(cylinder_bounds, dtype=float)
+
+        # Per mesh element counts and concentrations of each split column, filled
+        # by mesh_particles and lacey_mixing
+        self.cell_counts = {}
+        self.cell_concentrations = {}
 
 
     def time(self, timestep):
@@ -28,13 +65,28 @@ class ProcessSimulationTimestep():
         # If it does, append the new column to the particles file
         if 'id' in self.particles_file.point_data.keys() and self.particles_file.n_points != 0:
 
-            new_column = np.zeros(len(self.particles_file["id"]))
-            new_column[:] = np.nan
+            ids = self.particles_file["id"]
+
+            # Look up the value of every particle id in the sorted dictionary ids,
+            # particles missing from the dictionary are NaN (UNCLASSIFIED in compact
+            # mode). The ids and values can also be given as two arrays sorted by id
+            if isinstance(id_dict, dict):
+                keys = np.fromiter(id_dict.keys(), dtype=ids.dtype, count=len(id_dict))
+                values = np.fromiter(id_dict.values(), dtype=float, count=len(id_dict))
+                order = np.argsort(keys)
+                keys, values = keys[order], values[order]
+            else:
+                keys, values = id_dict
+
+            positions = np.minimum(np.searchsorted(keys, ids), max(len(keys) - 1, 0))
+            found = keys[positions] == ids if len(keys) else np.zeros(len(ids), dtype=bool)
+
+            if self.compact:
+                new_column = np.full(len(ids), UNCLASSIFIED, dtype=np.uint8)
+            else:
+                new_column = np.full(len(ids), np.nan)
+            new_column[found] = values[positions[found]]
 
-            # Loop through the id dictionary and assign the new column values
-            for key, value in id_dict.items():
-                new_column[self.particles_file["id"] == key] = value
-                
             self.particles_file[column_name] = new_column
 
         else:
@@ -46,7 +98,7 @@ class ProcessSimulationTimestep():
 
         return self.particles_file
 
-    def mesh_particles(self, mesh_resolution, mesh_constant="volume", start_rotation=0):
+    def mesh_particles(self, mesh_resolution, mesh_constant="volume", start_rotation=0, split_columns=None):
         
         # Check if the particles file has points
         if self.particles_file.n_points == 0:
@@ -71,8 +123,8 @@ class ProcessSimulationTimestep():
         self.mesh_resolution = mesh_resolution
 
         # determine the radius of the cylinder mesh
-        x_radii = abs(self.cylinder_file.bounds[1] - self.cylinder_file.bounds[0])/2
-        y_radii = abs(self.cylinder_file.bounds[3] - self.cylinder_file.bounds[2])/2
+        x_radii = abs(self.cylinder_bounds[1] - self.cylinder_bounds[0])/2
+        y_radii = abs(self.cylinder_bounds[3] - self.cylinder_bounds[2])/2
         
         # calculate the radial increments of the lacey meshing depending on a chosen constant
         if mesh_constant == "radius":
@@ -88,7 +140,7 @@ class ProcessSimulationTimestep():
             raise("Invalid mesh constant")
 
         # calculate linearly spaced z mesh boundaries
-        z_mesh_boundaries = np.linspace(self.cylinder_file.bounds[4], self.cylinder_file.bounds[5], z_mesh + 1)
+        z_mesh_boundaries = np.linspace(self.cylinder_bounds[4], self.cylinder_bounds[5], z_mesh + 1)
 
         # calculate linearly spaced angular mesh boundaries
         angular_mesh_boundaries = np.linspace(0, 2*np.pi, ang_mesh + 1)
@@ -97,69 +149,41 @@ class ProcessSimulationTimestep():
         self.radial_mesh_boundaries = radial_mesh_boundaries
         self.z_mesh_boundaries = z_mesh_boundaries
 
-        x_center = self.cylinder_file.center[0]
-        y_center = self.cylinder_file.center[1]
-
-        # calculate particle z positions
-        particle_z = self.particles_file.points[:,2]
-
-        # calculate particle radial positions
-        particle_radii = np.sqrt(
-            (self.particles_file.points[:, 0] - x_center)**2
-            + (self.particles_file.points[:, 1] - y_center)**2
+        x_center = (self.cylinder_bounds[0] + self.cylinder_bounds[1])/2
+        y_center = (self.cylinder_bounds[2] + self.cylinder_bounds[3])/2
+
+        # Particle classes of each split column, counted per mesh element in the
+        # same pass as the meshing
+        split_columns = [column for column in (split_columns or [])
+                         if column in self.particles_file.point_data.keys()]
+        classes = [self.particles_file[column] == 1 for column in split_columns]
+
+        # Assign each particle to a mesh element (numbered by z, then radius,
+        # then angle), -1 for particles outside the mesh
+        cell_ids, cell_totals, class_1_counts = bin_and_count(
+            self.particles_file.points, x_center, y_center, start_rotation,
+            angular_mesh_boundaries, radial_mesh_boundaries, z_mesh_boundaries,
+            np.array(classes) if classes else None
             )
 
-        # calculate particle angular positions for x rotate by pi/6
-        resolved_angular_data = ( np.arctan2(
-            (self.particles_file.points[:,1] - y_center),
-            (self.particles_file.points[:,0] - x_center)
-            ) + np.pi + start_rotation ) % (2*np.pi)
-
-        # Set up an nan list to hold particle mesh regions
-        particle_mesh_element = np.zeros(len(self.particles_file.points))
-        particle_mesh_element[:] = np.nan
-
-        # set mesh identifier counter
-        counter = 0
-
-        # Loop through the lacey mesh elements
-        for k in range(len(z_mesh_boundaries) - 1):
-
-            # Particle above lower z boundary
-            above_lower_z = particle_z >= z_mesh_boundaries[k]
-            # Particle below upper z boundary
-            below_upper_z = particle_z < z_mesh_boundaries[k+1]
-
-            for i in range(len(radial_mesh_boundaries) - 1):
-
-                # Particle above lower radial boundary
-                above_lower_r = particle_radii >= radial_mesh_boundaries[i]
-                # Particle below upper radial boundary
-                below_upper_r = particle_radii < radial_mesh_boundaries[i+1]
-
-                for j in range(len(angular_mesh_boundaries) - 1):
-
-                    # Particle above lower angular boundary
-                    above_lower_angle = resolved_angular_data >= angular_mesh_boundaries[j]
-                    # Particle below upper angular boundary
-                    below_upper_angle = resolved_angular_data < angular_mesh_boundaries[j+1]
-
-                    # pyvista_ndarray boolean mask outlining if a point lies within this
-                    # given mesh elemnent
-                    mesh_element = (
-                        (above_lower_z & below_upper_z) &
-                        (above_lower_r & below_upper_r) &
-                        (above_lower_angle & below_upper_angle)
-                    )
-
-                    # Write mesh identifier to particles inside the mesh element
-                    particle_mesh_element[mesh_element] = counter
-
-                    counter += 1
+        self.cell_ids = cell_ids.astype(np.int32) if self.compact else cell_ids
+        self.n_cells = ang_mesh * rad_mesh * z_mesh
+        self.mesh_center = (x_center, y_center)
+        self.start_rotation = start_rotation
+        self.cell_concentrations = {}
+        self.cell_counts = {column: (cell_totals, counts)
+                            for column, counts in zip(split_columns, class_1_counts)}
+
+        # Set up an nan list to hold particle mesh regions, or the integer mesh
+        # elements with OUT_OF_MESH in compact mode
+        if self.compact:
+            particle_mesh_element = self.cell_ids
+        else:
+            particle_mesh_element = np.where(cell_ids >= 0, cell_ids, np.nan)
 
         self.particles_file["mesh"] = particle_mesh_element
 
-        out_of_mesh_particles = sum(np.isnan(particle_mesh_element))
+        out_of_mesh_particles = int(np.sum(cell_ids < 0))
         in_mesh_particles = len(particle_mesh_element) - out_of_mesh_particles
 
         return [in_mesh_particles, out_of_mesh_particles]
@@ -172,82 +196,49 @@ class ProcessSimulationTimestep():
             warnings.warn(f"{split_column} not found in particle file, returning NaN")
             return [np.nan, np.nan]
 
-        if len(np.unique(self.particles_file[split_column])) != 2: 
+        particle_class = self.particle_classes(split_column)
+        if len(np.unique(particle_class[~np.isnan(particle_class)])) != 2: 
             raise Exception("Lacey can only support 2 particle types")
 
-        class_0_split = (self.particles_file[split_column].astype(int) 
-                        ^ np.ones(len(self.particles_file[split_column])).astype(int))
-
-        class_1_split = self.particles_file[split_column].astype(int)
-
-        mesh = self.particles_file[mesh_column]
-        mesh_ids = np.unique(mesh)
-        mesh_ids = mesh_ids[~np.isnan(mesh_ids)].astype(int)
-
-        mesh_id_booleans = []
-        for ids in mesh_ids:
-            mesh_boolean_mask = mesh == ids
-            mesh_id_booleans.append(mesh_boolean_mask)
-
-        num_particle_class_0_meshed = []
-        num_particle_class_1_meshed = []
-        total_num_mesh_particle = []
-
-        # Set up an nan list to hold particle concentrations
-        particles_concentration = np.zeros(len(self.particles_file.points))
-        particles_concentration[:] = np.nan
-
-        # Set up an nan list to hold particle mesh regions
-        mesh_elements = np.zeros(len(self.particles_file.points))
-        mesh_elements[:] = np.nan
-
-
-        # Initial number of dropped particles before looping through mesh elements
-        dropped_particles = 0
-        # Initial number of lacey mesh elements used for lacey mixing
-        n_mesh_elements = 0
-
-        # Loop through the lacey mesh elements
-        for mesh_element in mesh_id_booleans:
-
-            mesh_particles_class_0 = class_0_split & mesh_element
-            mesh_particles_class_1 = class_1_split & mesh_element
+        # Reuse the per mesh element counts from `mesh_particles` if available,
+        # otherwise count the particles of each class per mesh element
+        if mesh_column == "mesh" and split_column in self.cell_counts:
+            cell_ids = self.cell_ids
+            cell_totals, cell_class_1 = self.cell_counts[split_column]
+        else:
+            mesh = self.particles_file[mesh_column]
+            cell_ids = np.where(np.isnan(mesh), OUT_OF_MESH, mesh).astype(np.int64)
+            cell_totals, cell_class_1 = count_cells(
+                cell_ids, self.particles_file[split_column] == 1, int(cell_ids.max()) + 1
+                )
 
-            num_particle_class_0 = sum(mesh_particles_class_0)
-            num_particle_class_1 = sum(mesh_particles_class_1)
-            total_num_particle = num_particle_class_0 + num_particle_class_1
+            if mesh_column == "mesh":
+                self.cell_counts[split_column] = (cell_totals, cell_class_1)
 
-            if total_num_particle >= min_particles:
+        # Mesh elements with enough particles are used for lacey mixing, the
+        # particles in other non-empty mesh elements are dropped
+        used_cells = (cell_totals >= min_particles) & (cell_totals > 0)
+        dropped_particles = int(np.sum(cell_totals[~used_cells]))
+        n_mesh_elements = int(np.sum(used_cells))
 
-                # Append number of particles of class 0 and 1 present in the lacey mesh
-                # element to the relevent arrays
-                num_particle_class_0_meshed.append(num_particle_class_0)
-                num_particle_class_1_meshed.append(num_particle_class_1)
-                total_num_mesh_particle.append(total_num_particle)
+        num_particle_class_1_meshed = cell_class_1[used_cells]
+        total_num_mesh_particle = cell_totals[used_cells]
+        num_particle_class_0_meshed = total_num_mesh_particle - num_particle_class_1_meshed
 
-                # Assign the concentration value of the mesh element to all particles that
-                # reside in the mesh element. Used for concentration visualisation
-                particles_concentration[mesh_element] = (
-                    num_particle_class_1
-                        / (
-                            num_particle_class_0
-                            + num_particle_class_1
-                        )
-                    )
+        # Assign the concentration value of the mesh element to all particles that
+        # reside in the mesh element. Used for concentration visualisation
+        cell_concentration = np.full(len(cell_totals), np.nan)
+        cell_concentration[used_cells] = num_particle_class_1_meshed / total_num_mesh_particle
 
-                # All particles present in the mesh
-                n_mesh_elements += 1
+        if mesh_column == "mesh":
+            self.cell_concentrations[split_column] = cell_concentration
 
-            else:
-                dropped_particles += total_num_particle
+        particles_concentration = np.full(len(cell_ids), np.nan, dtype=self.float_dtype)
+        in_mesh = cell_ids >= 0
+        particles_concentration[in_mesh] = cell_concentration[cell_ids[in_mesh]]
 
         # Append particle concentration and mesh elements to the self.particles_file
         self.particles_file[f"{split_column}_concentration"] = particles_concentration
-        
-        # Convert lists to numpy arrays
-        num_particle_class_1_meshed = np.asarray(num_particle_class_1_meshed)
-        num_particle_class_0_meshed = np.asarray(num_particle_class_0_meshed)
-        total_num_mesh_particle = np.asarray(total_num_mesh_particle)
 
         # Calculate lacey mixing index
         if n_mesh_elements < 2:
@@ -286,12 +277,270 @@ class ProcessSimulationTimestep():
         return [lacey, dropped_particles]
 
 
+    def particle_classes(self, split_column):
+
+        # Class labels of a split column as floats, NaN for unclassified particles
+        particle_class = np.asarray(self.particles_file[split_column], dtype=float)
+
+        if self.compact:
+            particle_class[particle_class == UNCLASSIFIED] = np.nan
+
+        return particle_class
+
+
+    def neighbour_tree(self):
+
+        # KD-tree of the particle positions, built once per dump and shared by
+        # the mesh-free indices
+        if getattr(self, "tree", None) is None:
+            self.tree = cKDTree(self.particles_file.points)
+
+        return self.tree
+
+
+    def nearest_neighbours(self, n_neighbours, sample_size=None, seed=0, workers=1):
+
+        # Indices of the queried particles (all particles, or sample_size randomly
+        # chosen ones) and of their n_neighbours nearest neighbours. The neighbours
+        # do not depend on the split column, so the query is run once per dump and
+        # reused by later calls for as many neighbours or fewer with the same
+        # sample. workers is the number of query threads, 1 in pool workers
+        cached = getattr(self, "neighbours", None)
+
+        if cached is None or cached[0] != (sample_size, seed) or cached[2].shape[1] < n_neighbours:
+            points = self.particles_file.points
+
+            if sample_size is not None and sample_size < len(points):
+                sampled = np.random.default_rng(seed).choice(len(points), sample_size, replace=False)
+            else:
+                sampled = np.arange(len(points))
+
+            # The first neighbour returned is the particle itself
+            _, neighbours = self.neighbour_tree().query(points[sampled], k=n_neighbours + 1, workers=workers)
+            self.neighbours = ((sample_size, seed), sampled, neighbours[:, 1:].astype(np.int32))
+
+        _, sampled, neighbours = self.neighbours
+
+        return sampled, neighbours[:, :n_neighbours]
+
+
+    def neighbour_mixing(self, split_column, n_neighbours=12, sample_size=None, seed=0, workers=1):
+
+        # Mesh-free Lacey index from the class fraction among the k nearest
+        # neighbours of each particle, so independent of mesh_resolution and
+        # min_particles and including particles near the wall. The variance of
+        # the neighbourhood fractions is normalised between the segregated
+        # p(1-p) and random p(1-p)/k limits as for lacey_mixing. With a
+        # sample_size, only that many randomly chosen particles are queried
+        # against the full tree, for large dumps
+        if split_column not in self.particles_file.point_data.keys():
+            warnings.warn(f"{split_column} not found in particle file, returning NaN")
+            return [np.nan, 0]
+
+        if self.particles_file.n_points <= n_neighbours:
+            warnings.warn(f"Fewer than {n_neighbours + 1} particles in file {self.filename}, returning NaN")
+            return [np.nan, 0]
+
+        particle_class = self.particle_classes(split_column)
+        points = self.particles_file.points
+
+        sampled, neighbours = self.nearest_neighbours(n_neighbours, sample_size, seed, workers)
+        neighbour_class = particle_class[neighbours]
+
+        # Particles without a class (not in the split dictionary) are ignored
+        valid_neighbours = np.sum(~np.isnan(neighbour_class), axis=1)
+        with np.errstate(invalid="ignore"):
+            neighbour_concentration = np.nansum(neighbour_class, axis=1) / valid_neighbours
+
+        particles_neighbour_concentration = np.full(len(points), np.nan, dtype=self.float_dtype)
+        particles_neighbour_concentration[sampled] = neighbour_concentration
+        self.particles_file[f"{split_column}_neighbour_concentration"] = particles_neighbour_concentration
+
+        used = ~np.isnan(particle_class[sampled]) & (valid_neighbours == n_neighbours)
+        bulk_concentration = np.nanmean(particle_class)
+        unmixed_variance = bulk_concentration * (1 - bulk_concentration)
+
+        if np.sum(used) < 2 or unmixed_variance == 0:
+            warnings.warn(f"Too few classified particles in file {self.filename}, setting neighbour mixing to NaN")
+            return [np.nan, int(np.sum(used))]
+
+        variance = np.mean((neighbour_concentration[used] - bulk_concentration) ** 2)
+        mixed_variance = unmixed_variance / n_neighbours
+
+        neighbour_lacey = (variance - unmixed_variance) / (mixed_variance - unmixed_variance)
+
+        return [neighbour_lacey, int(np.sum(used))]
+
+
+    def mixing_metrics(self, split_column, min_particles, n_correlation_bins=20, sample_size=None, seed=0,
+                       workers=1):
+
+        # Further mixing indices from the same per mesh element counts as
+        # lacey_mixing, plus a mesh-free index from the nearest neighbour of
+        # each particle, to check whether trends in Lacey are mesh artefacts:
+        #   segregation intensity: Danckwerts' intensity, the variance of the
+        #       concentration over the mesh normalised by p(1-p), 1 when fully
+        #       segregated and ~0 when mixed
+        #   scale of segregation: Danckwerts' scale, the integral of the spatial
+        #       correlogram of the concentration up to its first zero, in the
+        #       length units of the simulation
+        #   mixing entropy: the particle weighted binary entropy of the mesh
+        #       elements normalised by the entropy of the bulk, 0 when fully
+        #       segregated and 1 when mixed
+        #   contact index: the fraction of particles whose nearest neighbour is
+        #       of the other class, normalised by 2p(1-p), ~1 when mixed. Uses the
+        #       same (optionally sampled) neighbours as neighbour_mixing
+        metrics = {"segregation intensity": np.nan, "scale of segregation": np.nan,
+                   "mixing entropy": np.nan, "contact index": np.nan}
+
+        if split_column not in self.particles_file.point_data.keys():
+            warnings.warn(f"{split_column} not found in particle file, returning NaN")
+            return metrics
+
+        if split_column not in self.cell_counts:
+            raise Exception("mesh_particles must be called with the split column before mixing_metrics")
+
+        cell_totals, cell_class_1 = self.cell_counts[split_column]
+        used_cells = (cell_totals >= min_particles) & (cell_totals > 0)
+
+        if np.sum(used_cells) < 2:
+            warnings.warn(f"Fewer than 2 non-empty lacey mesh for file {self.filename} setting metrics to NaN")
+            return metrics
+
+        totals = cell_totals[used_cells]
+        concentrations = cell_class_1[used_cells] / totals
+        weights = totals / np.sum(totals)
+        bulk_concentration = np.sum(weights * concentrations)
+        unmixed_variance = bulk_concentration * (1 - bulk_concentration)
+
+        # Intensity of segregation
+        variance = np.sum(weights * (concentrations - bulk_concentration) ** 2)
+        metrics["segregation intensity"] = variance / unmixed_variance
+
+        # Entropy of mixing, with 0 log 0 taken as 0
+        def binary_entropy(c):
+            c = np.clip(c, 1e-12, 1 - 1e-12)
+            return -(c * np.log(c) + (1 - c) * np.log(1 - c))
+
+        metrics["mixing entropy"] = (np.sum(weights * binary_entropy(concentrations))
+                                     / binary_entropy(bulk_concentration))
+
+        # Scale of segregation. The correlogram is binned by the distance between
+        # mesh element centres, with the sums over pairs of elements done by
+        # weighted pair counting on a KD-tree of the centres
+        z_centres, radial_centres, angular_centres = np.meshgrid(
+            (self.z_mesh_boundaries[:-1] + self.z_mesh_boundaries[1:]) / 2,
+            (self.radial_mesh_boundaries[:-1] + self.radial_mesh_boundaries[1:]) / 2,
+            (self.angular_mesh_boundaries[:-1] + self.angular_mesh_boundaries[1:]) / 2,
+            indexing="ij")
+
+        centres = np.column_stack([
+            (radial_centres * np.cos(angular_centres)).ravel(),
+            (radial_centres * np.sin(angular_centres)).ravel(),
+            z_centres.ravel()])[used_cells]
+
+        cell_variance = np.var(concentrations)
+        if cell_variance > 0:
+            deviations = concentrations - np.mean(concentrations)
+            distances = np.linspace(0, self.radial_mesh_boundaries[-1] * 2, n_correlation_bins + 1)
+
+            centre_tree = cKDTree(centres)
+            pairs = centre_tree.count_neighbors(centre_tree, distances, cumulative=False)
+            products = centre_tree.count_neighbors(centre_tree, distances, cumulative=False,
+                                                   weights=(deviations, deviations))
+
+            # The first bin only holds each element paired with itself
+            with np.errstate(invalid="ignore", divide="ignore"):
+                correlogram = products[1:] / pairs[1:] / cell_variance
+            correlogram = np.concatenate([[1.0], np.nan_to_num(correlogram)])
+
+            first_zero = np.argmax(correlogram <= 0) if np.any(correlogram <= 0) else len(correlogram)
+            bin_centres = np.concatenate([[0.0], (distances[1:-1] + distances[2:]) / 2])
+            correlogram, bin_centres = correlogram[:first_zero], bin_centres[:first_zero]
+            metrics["scale of segregation"] = np.sum(np.diff(bin_centres) * (correlogram[1:] + correlogram[:-1]) / 2)
+
+        # Contact index from the nearest neighbour of each queried particle
+        particle_class = self.particle_classes(split_column)
+        particle_p = np.nanmean(particle_class)
+
+        if 0 < particle_p < 1:
+            sampled, neighbours = self.nearest_neighbours(1, sample_size, seed, workers)
+            own_class = particle_class[sampled]
+            neighbour_class = particle_class[neighbours[:, 0]]
+            valid = ~np.isnan(own_class) & ~np.isnan(neighbour_class)
+            contacts = np.mean(own_class[valid] != neighbour_class[valid])
+            metrics["contact index"] = contacts / (2 * particle_p * (1 - particle_p))
+
+        return metrics
+
+
+    def concentration_field(self):
+
+        # Per mesh element particle counts and concentrations of every split
+        # column passed through lacey_mixing, shaped (z, radial, angular) to
+        # match the cylindrical mesh of mesh_particles
+        if not hasattr(self, "cell_ids"):
+            raise Exception("mesh_particles must be called before exporting the concentration field")
+
+        shape = (len(self.z_mesh_boundaries) - 1,
+                 len(self.radial_mesh_boundaries) - 1,
+                 len(self.angular_mesh_boundaries) - 1)
+
+        field = {"step": self.file_name_id,
+                 "angular_mesh_boundaries": self.angular_mesh_boundaries,
+                 "radial_mesh_boundaries": self.radial_mesh_boundaries,
+                 "z_mesh_boundaries": self.z_mesh_boundaries,
+                 "mesh_center": np.asarray(self.mesh_center),
+                 "start_rotation": self.start_rotation,
+                 "particles": np.bincount(self.cell_ids[self.cell_ids >= 0],
+                                          minlength=self.n_cells).reshape(shape)}
+
+        for split_column, (_, cell_class_1) in self.cell_counts.items():
+            field[f"{split_column}_class_1"] = cell_class_1.reshape(shape)
+
+        for split_column, cell_concentration in self.cell_concentrations.items():
+            field[f"{split_column}_concentration"] = cell_concentration.reshape(shape)
+
+        return field
+
+
+    def save_concentration_field(self, save_file):
+
+        # Save the concentration field as a compressed NumPy archive (.npz) or
+        # as a structured grid of the cylindrical mesh (.vts) for visualisation
+        field = self.concentration_field()
+
+        if save_file.endswith(".npz"):
+            np.savez_compressed(save_file, **field)
+            return
+
+        # Mesh element nodes, with the angle converted back from the rotated
+        # angle used for meshing. The angular index varies fastest, so the cell
+        # order of the grid matches the mesh element numbering
+        angles = self.angular_mesh_boundaries - np.pi - self.start_rotation
+        theta, radius, z = np.meshgrid(angles, self.radial_mesh_boundaries,
+                                       self.z_mesh_boundaries, indexing="ij")
+
+        grid = pv.StructuredGrid(self.mesh_center[0] + radius*np.cos(theta),
+                                 self.mesh_center[1] + radius*np.sin(theta),
+                                 z)
+
+        for name, values in field.items():
+            if isinstance(values, np.ndarray) and values.shape == field["particles"].shape:
+                grid.cell_data[name] = values.ravel()
+
+        grid.save(save_file)
+
+
     def save_particles(self, save_file):
         self.particles_file.save(save_file)
 
 
-def split_particles(settled_file, split_dimension):
+def split_particles(settled_file, split_dimension, compact=False):
 
+    # Class label of every particle id of the settled file. In compact mode these
+    # are returned as an array of sorted ids and an array of uint8 labels rather
+    # than a dictionary, which is much smaller to send to each worker
     settled_data = pv.read(settled_file)
     split_column = f"{split_dimension}_class"
 
@@ -315,15 +564,15 @@ def split_particles(settled_file, split_dimension):
     elif split_dimension == "radius":
 
         radii = np.unique(settled_data["radius"])
-        split_class = np.zeros(settled_data.n_points)
-        split_class[:] = np.nan
-        for i, radius in enumerate(radii):
-            boolean_mask = [settled_data["radius"] == radius]
-            split_class[boolean_mask] = i
+        split_class = np.searchsorted(radii, settled_data["radius"])
 
     else:
         raise ValueError(f"{split_dimension} is not a recognised split dimension")
 
-    split_dict = dict(map(lambda i,j : (i,j), settled_data["id"], split_class))
+    if compact:
+        order = np.argsort(settled_data["id"])
+        return (settled_data["id"][order], split_class[order].astype(np.uint8)), split_column
+
+    split_dict = dict(zip(settled_data["id"].tolist(), split_class.astype(int).tolist()))
 
     return split_dict, split_column
\ No newline at end of file
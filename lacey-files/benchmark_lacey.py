@@ -0,0 +1,242 @@
+from ProcessSimulation import ProcessSimulationTimestep, split_particles
+from calculate_lacey import parallel_run
+from pipeline_timing import StageTimer, summarise_stages
+
+import numpy as np
+import pyvista as pv
+import pandas as pd
+import os
+import time
+import argparse
+import tempfile
+import platform
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+stl_file = os.path.join(script_dir, "..", "study-templates", "cylinder.stl")
+
+# cylinder.stl is in mm and scaled by 1e-3 in resodyn.sim
+stl_scale = 1e-3
+
+split_dimensions = ["x", "y", "z", "r"]
+mesh_constant = "volume"
+mesh_column = "mesh"
+timestep = 1e-5
+dump_interval = 10000
+min_particles = 10
+
+
+def generate_synthetic_study(study_dir, n_particles, n_dumps, binary=True, fill_fraction=0.6, seed=0):
+
+    # Writes `n_dumps` LIGGGHTS-like particle dumps and matching cylinder mesh dumps
+    # into study_dir/post. Particles fill the bottom `fill_fraction` of the cylinder
+    # from cylinder.stl, with a bidisperse size distribution and shuffled ids
+    post_dir = os.path.join(study_dir, "post")
+    os.makedirs(post_dir, exist_ok=True)
+
+    cylinder = pv.read(stl_file).scale(stl_scale)
+    x_min, x_max, y_min, y_max, z_min, z_max = cylinder.bounds
+    radius = min(x_max - x_min, y_max - y_min) / 2
+    x_center, y_center = cylinder.center[0], cylinder.center[1]
+    fill_height = fill_fraction * (z_max - z_min)
+
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(n_particles) + 1
+    radii = rng.choice([5e-4, 6e-4], n_particles)
+
+    for dump in range(n_dumps):
+        step = dump * dump_interval
+
+        # Uniform positions within the filled part of the cylinder
+        r = radius * np.sqrt(rng.random(n_particles))
+        theta = 2 * np.pi * rng.random(n_particles)
+        points = np.column_stack([x_center + r * np.cos(theta),
+                                  y_center + r * np.sin(theta),
+                                  z_min + fill_height * rng.random(n_particles)])
+
+        particles = pv.PolyData(points)
+        particles["id"] = ids
+        particles["type"] = np.ones(n_particles, dtype=int)
+        particles["v"] = rng.normal(0, 0.1, (n_particles, 3))
+        particles["radius"] = radii
+        particles.save(os.path.join(post_dir, f"particles_{step}.vtk"), binary=binary)
+
+        cylinder.save(os.path.join(post_dir, f"mesh_{step}.vtk"), binary=binary)
+
+    return post_dir
+
+
+def dump_files(post_dir, n_dumps):
+
+    return [(os.path.join(post_dir, f"particles_{dump * dump_interval}.vtk"),
+             os.path.join(post_dir, f"mesh_{dump * dump_interval}.vtk"))
+            for dump in range(n_dumps)]
+
+
+def warm_up(post_dir, mesh_resolution):
+
+    # Meshes the first dump once with float64 and once with compact float32
+    # positions, untimed, so compiling the Numba kernel for each dtype (after an
+    # edit leaves its cache cold) is not counted in the first timed dump
+    particles_file, cylinder_file = dump_files(post_dir, 1)[0]
+
+    for compact in (False, True):
+        state = ProcessSimulationTimestep(particles_file, cylinder_file, compact=compact)
+        state.mesh_particles(mesh_resolution, mesh_constant, 0)
+
+
+def benchmark_stages(post_dir, n_dumps, mesh_resolution, timer):
+
+    # Times each stage of the pipeline for every dump in a single process
+    files = dump_files(post_dir, n_dumps)
+    settled_file = files[0][0]
+
+    warm_up(post_dir, mesh_resolution)
+
+    with timer.stage("split particles", nbytes=os.path.getsize(settled_file)):
+        splits = [split_particles(settled_file, dim) for dim in split_dimensions]
+
+    save_dir = tempfile.mkdtemp(dir=post_dir)
+
+    for particles_file, cylinder_file in files:
+        nbytes = os.path.getsize(particles_file) + os.path.getsize(cylinder_file)
+
+        with timer.stage("read", nbytes=nbytes) as record:
+            state = ProcessSimulationTimestep(particles_file, cylinder_file)
+            n_points = state.particles_file.n_points
+            record["items"] = n_points
+
+        with timer.stage("append columns", items=4 * n_points):
+            for split_dict, split_column in splits:
+                state.append_particle_column(split_dict, split_column)
+
+        with timer.stage("mesh particles", items=n_points):
+            state.mesh_particles(mesh_resolution, mesh_constant, 0,
+                                 [split_column for _, split_column in splits])
+
+        with timer.stage("lacey mixing", items=4 * n_points):
+            for _, split_column in splits:
+                state.lacey_mixing(split_column, mesh_column, min_particles)
+
+        save_file = os.path.join(save_dir, f"lacey_{state.filename}")
+        with timer.stage("save particles", items=n_points) as record:
+            state.save_particles(save_file)
+            record["bytes"] = os.path.getsize(save_file)
+
+
+def benchmark_workers(post_dir, n_dumps, mesh_resolution, max_workers):
+
+    # Wall time of the whole parallel pipeline over all dumps with a given worker count
+    files = dump_files(post_dir, n_dumps)
+    splits = [split_particles(files[0][0], dim) for dim in split_dimensions]
+    split_dicts = [split_dict for split_dict, _ in splits]
+    split_columns = [split_column for _, split_column in splits]
+
+    save_dir = tempfile.mkdtemp(dir=post_dir)
+
+    start = time.perf_counter()
+
+    states = [ProcessSimulationTimestep(particles_file, cylinder_file) for particles_file, cylinder_file in files]
+    save_files = [os.path.join(save_dir, f"lacey_{state.filename}") for state in states]
+
+    args = ((state, save_file, split_dicts, split_columns, mesh_resolution, mesh_constant,
+             0, timestep, min_particles, mesh_column) for state, save_file in zip(states, save_files))
+
+    # The stage benchmarks have already started Numba's threads in this process,
+    # so workers are spawned rather than forked, which can deadlock
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        list(executor.map(parallel_run, *zip(*args)))
+
+    return time.perf_counter() - start
+
+
+def run_benchmarks(particle_counts, mesh_resolutions, worker_counts, n_dumps, binary, work_dir):
+
+    rows = []
+
+    for n_particles in particle_counts:
+        study_dir = os.path.join(work_dir, f"synthetic_{n_particles}")
+
+        start = time.perf_counter()
+        post_dir = generate_synthetic_study(study_dir, n_particles, n_dumps, binary)
+        print(f"Generated {n_dumps} dumps of {n_particles} particles in {time.perf_counter() - start:.1f} s")
+
+        for mesh_resolution in mesh_resolutions:
+            config = {"particles": n_particles,
+                      "mesh resolution": "x".join(str(i) for i in mesh_resolution),
+                      "format": "binary" if binary else "ascii"}
+
+            timer = StageTimer()
+            benchmark_stages(post_dir, n_dumps, mesh_resolution, timer)
+
+            for stage, row in summarise_stages(timer.records).iterrows():
+                rows.append({**config, "benchmark": stage, "workers": 1,
+                             "seconds per dump": row["total_s"] / n_dumps,
+                             "particles per s": row["particles_per_s"],
+                             "MB per s": row["MB_per_s"]})
+
+            for workers in worker_counts:
+                wall_time = benchmark_workers(post_dir, n_dumps, mesh_resolution, workers)
+                rows.append({**config, "benchmark": "pipeline", "workers": workers,
+                             "seconds per dump": wall_time / n_dumps,
+                             "particles per s": n_particles * n_dumps / wall_time,
+                             "MB per s": np.nan})
+
+            print(f"Finished {config['particles']} particles at mesh resolution {config['mesh resolution']}")
+
+    return pd.DataFrame(rows)
+
+
+def compare_to_baseline(results, baseline_file):
+
+    # Ratio of the current to the baseline time per dump (> 1 is a slowdown)
+    keys = ["particles", "mesh resolution", "format", "benchmark", "workers"]
+    baseline = pd.read_csv(baseline_file)
+
+    comparison = results.merge(baseline[keys + ["seconds per dump"]], on=keys, how="inner",
+                               suffixes=("", " baseline"))
+    comparison["ratio"] = comparison["seconds per dump"] / comparison["seconds per dump baseline"]
+
+    return comparison
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the Lacey pipeline on synthetic LIGGGHTS-like dumps")
+    parser.add_argument("--particles", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--mesh-resolutions", nargs="+", default=["8,6,20"],
+                        help="angular,radial,z mesh resolutions, e.g. 8,6,20 16,12,40")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count()])
+    parser.add_argument("--dumps", type=int, default=4)
+    parser.add_argument("--ascii", action="store_true", help="write ASCII instead of binary VTK dumps")
+    parser.add_argument("--output-dir", default="benchmark_results")
+    parser.add_argument("--baseline", help="previous results CSV to compare against")
+    args = parser.parse_args()
+
+    mesh_resolutions = [[int(i) for i in resolution.split(",")] for resolution in args.mesh_resolutions]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args.particles, mesh_resolutions, sorted(set(args.workers)),
+                                 args.dumps, not args.ascii, work_dir)
+
+    results["machine"] = platform.node()
+    results["cpus"] = os.cpu_count()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_file = os.path.join(args.output_dir, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+    results.to_csv(results_file, index=False)
+
+    print(results.drop(columns=["machine", "cpus"]).round(4).to_string(index=False))
+    print(f"Benchmark results saved to {results_file}")
+
+    if args.baseline:
+        comparison = compare_to_baseline(results, args.baseline)
+        print("Comparison to baseline (ratio > 1 is slower):")
+        print(comparison[["particles", "mesh resolution", "benchmark", "workers", "ratio"]]
+              .round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
 from ProcessSimulation import ProcessSimulationTimestep, split_particles
+from lacey_kernels import set_num_threads
 
 import numpy as np
 import os
+import sys
 import glob
 from natsort import natsorted
 from tqdm import tqdm
 import pandas as pd
+import threading
+import multiprocessing
 from concurrent.futures import ProcessPoolExecutor
+from pipeline_timing import StageTimer, print_timing_summary, write_trace
+from vessel_motion import study_vessel_motion
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "study-setup"))
+import sweep_manifest
 
 def parallel_run(simulation_state,
                  save_file,
@@ -17,63 +26,321 @@ def parallel_run(simulation_state,
                  start_rotation, 
                  timestep, 
                  min_particles, 
-                 mesh_column):
+                 mesh_column,
+                 save_particle_file=True,
+                 field_format=None,
+                 compute_metrics=False,
+                 n_neighbours=12,
+                 neighbour_sample_size=None,
+                 kernel_threads=1):
     
+    timer = StageTimer()
+    set_num_threads(kernel_threads)
+    n_points = simulation_state.particles_file.n_points
+
     x_split_dict, y_split_dict, z_split_dict, r_split_dict = split_dicts
     x_split_column, y_split_column, z_split_column, r_split_column = split_columns
 
-    simulation_state.append_particle_column(x_split_dict, x_split_column)
-    simulation_state.append_particle_column(y_split_dict, y_split_column)
-    simulation_state.append_particle_column(z_split_dict, z_split_column)
-    simulation_state.append_particle_column(r_split_dict, r_split_column)
-
-    in_mesh_particles, out_of_mesh_particles = simulation_state.mesh_particles(
-                                                mesh_resolution, mesh_constant, start_rotation
-                                                )
+    with timer.stage("append columns", items=4 * n_points):
+        simulation_state.append_particle_column(x_split_dict, x_split_column)
+        simulation_state.append_particle_column(y_split_dict, y_split_column)
+        simulation_state.append_particle_column(z_split_dict, z_split_column)
+        simulation_state.append_particle_column(r_split_dict, r_split_column)
 
-    x_lacey, dropped_particles = simulation_state.lacey_mixing(
-                                                    x_split_column, mesh_column, min_particles
+    with timer.stage("mesh particles", items=n_points):
+        in_mesh_particles, out_of_mesh_particles = simulation_state.mesh_particles(
+                                                    mesh_resolution, mesh_constant, start_rotation,
+                                                    split_columns
                                                     )
 
-    y_lacey, dropped_particles = simulation_state.lacey_mixing(
-                                                    y_split_column, mesh_column, min_particles
-                                                    )
+    with timer.stage("lacey mixing", items=4 * n_points):
+        x_lacey, dropped_particles = simulation_state.lacey_mixing(
+                                                        x_split_column, mesh_column, min_particles
+                                                        )
 
-    z_lacey, dropped_particles = simulation_state.lacey_mixing(
-                                                    z_split_column, mesh_column, min_particles
-                                                    )
+        y_lacey, dropped_particles = simulation_state.lacey_mixing(
+                                                        y_split_column, mesh_column, min_particles
+                                                        )
 
-    r_lacey, dropped_particles = simulation_state.lacey_mixing(
-                                                    r_split_column, mesh_column, min_particles
-                                                    )
+        z_lacey, dropped_particles = simulation_state.lacey_mixing(
+                                                        z_split_column, mesh_column, min_particles
+                                                        )
+
+        r_lacey, dropped_particles = simulation_state.lacey_mixing(
+                                                        r_split_column, mesh_column, min_particles
+                                                        )
+
+    # Segregation intensity, scale of segregation, mixing entropy and contact
+    # index from the same mesh counts, and the mesh-free neighbour mixing index,
+    # flattened per split column. The nearest neighbours are found once, on one
+    # thread as each worker has a core, and shared by every split column
+    metrics = None
+    if compute_metrics:
+        with timer.stage("mixing metrics", items=4 * n_points):
+            if n_points > n_neighbours:
+                simulation_state.nearest_neighbours(n_neighbours, neighbour_sample_size)
+
+            metrics = []
+            for split_column in split_columns:
+                metrics.extend(simulation_state.mixing_metrics(split_column, min_particles,
+                                                               sample_size=neighbour_sample_size).values())
+                metrics.append(simulation_state.neighbour_mixing(split_column, n_neighbours,
+                                                                  neighbour_sample_size)[0])
 
     time = simulation_state.time(timestep)
 
-    simulation_state.save_particles(save_file)
+    if save_particle_file:
+        with timer.stage("save particles", items=n_points) as record:
+            simulation_state.save_particles(save_file)
+            record["bytes"] = os.path.getsize(save_file)
+
+    # Per mesh element counts and concentrations, a compact alternative to the
+    # particle file for mixing maps. Empty dumps are not meshed, so have no field
+    field = None
+    if hasattr(simulation_state, "cell_ids"):
+        field = simulation_state.concentration_field()
+
+        if field_format is not None:
+            field_file = os.path.join(os.path.dirname(save_file),
+                                      f"lacey_field_{simulation_state.file_name_id}.{field_format}")
+
+            with timer.stage("save field") as record:
+                simulation_state.save_concentration_field(field_file)
+                record["bytes"] = os.path.getsize(field_file)
 
     return [time, x_lacey, y_lacey, z_lacey, r_lacey, 
-                in_mesh_particles, out_of_mesh_particles, dropped_particles]
+                in_mesh_particles, out_of_mesh_particles, dropped_particles], timer.records, field, metrics
 
 # Example name
 study_format = "num_particles: *, fric_pp: *, amp: *" 
+sweep_dir = "../sweep_output"
 
-def main():
-    # Mesh parameters
-    cylinder_prefix = "mesh_"
-    split_dimensions = ["x", "y", "z", "r"]
-    mesh_resolution = [8,6,20]
-    mesh_constant = "volume"
-    mesh_column = "mesh"
-
-    # Simulation parameters
-    timestep = 1e-5
-    dumpstep = 0.1
-    settled_time = 2
-
-    # Lacey mixing parameters
-    min_particles = 10
-    start_rotation = 0
+# Mesh parameters
+cylinder_prefix = "mesh_"
+split_dimensions = ["x", "y", "z", "r"]
+mesh_resolution = [8,6,20]
+mesh_constant = "volume"
+mesh_column = "mesh"
+
+# Compute the vessel position of each dump from the wiggle motion in the study's
+# LIGGGHTS script instead of reading every mesh file. The motion is checked
+# against the first validation_mesh_files mesh files, and every mesh file is read
+# if it does not match to within validation_tolerance (m)
+analytic_vessel_motion = True
+sim_file_name = "resodyn.sim"
+validation_mesh_files = 5
+validation_tolerance = 1e-5
+
+# Simulation parameters
+timestep = 1e-5
+dumpstep = 0.1
+settled_time = 2
+
+# Compact mode: float32 positions and columns, uint8 class labels and int32 mesh
+# elements instead of float64, for about half the memory per worker with large
+# dumps
+compact = False
+
+# Lacey mixing parameters
+min_particles = 10
+start_rotation = 0
+
+# Numba threads of the meshing kernel in each worker process. The pool already
+# runs a worker per core, so more threads per worker oversubscribe the node
+kernel_threads = 1
 
+# Outputs: particle files with the lacey columns appended, a concentration field
+# per dump ("npz", "vts" or None) and all concentration fields of a study stacked
+# into one post/lacey_concentration_fields.npz file
+save_particle_files = True
+field_format = None
+save_study_fields = True
+
+# Further mixing metrics (segregation intensity, scale of segregation, mixing
+# entropy, contact index and the mesh-free neighbour mixing index) saved to
+# post/mixing_metrics.csv in each study. Off by default, as they can take longer
+# than the Lacey index itself. The contact and neighbour mixing indices query the
+# n_neighbours nearest particles of neighbour_sample_size random particles (None
+# for all particles)
+compute_mixing_metrics = False
+mixing_metrics = ["segregation intensity", "scale of segregation", "mixing entropy", "contact index",
+                  "neighbour mixing"]
+n_neighbours = 12
+neighbour_sample_size = None
+
+# Per stage timings of the whole run, as a Chrome trace and a summary table
+timing_trace_file = "lacey_timing_trace.json"
+timing_summary_file = "lacey_timing_summary.csv"
+
+
+def save_stacked_fields(save_file, times, fields):
+    # Stacks the concentration fields of every dump of a study along a leading
+    # time axis. The mesh moves with the vessel, so its boundaries and centre are
+    # stacked per dump too. Dumps without a field (empty particle files) are NaN
+    template = next((field for field in fields if field is not None), None)
+    if template is None:
+        print(f"No concentration fields to save to {save_file}")
+        return
+
+    stacked = {"time": np.asarray(times)}
+    for key, value in template.items():
+        missing = np.full(np.shape(value), np.nan)
+        stacked[key] = np.stack([missing if field is None else field[key] for field in fields])
+
+    np.savez_compressed(save_file, **stacked)
+
+
+def study_particle_files(study):
+    # All particle files in a study, in dump order
+    glob_input = os.path.join(study, "post", "particles_*")
+    return natsorted([f for f in glob.glob(glob_input) if "boundingBox" not in f])
+
+
+def prepare_study(study, files, timer):
+    # The particle classes of each split dimension, from the settled file of
+    # the study, and the vessel motion if it can be computed
+    settled_file = files[round(settled_time/dumpstep)]
+
+    split_dicts = []
+    split_columns = []
+    for split_dimension in split_dimensions:
+        with timer.stage("split particles", nbytes=os.path.getsize(settled_file)):
+            split_dict, split_column = split_particles(settled_file, split_dimension, compact)
+        split_dicts.append(split_dict)
+        split_columns.append(split_column)
+
+    vessel_motion = None
+    if analytic_vessel_motion:
+        with timer.stage("vessel motion"):
+            vessel_motion = study_vessel_motion(study, sim_file_name, cylinder_prefix,
+                                                validation_mesh_files, validation_tolerance)
+
+    return split_dicts, split_columns, vessel_motion
+
+
+def load_simulation_state(particles_file, vessel_motion, timer):
+    file_name_id = os.path.basename(particles_file).split("_")[1].split(".")[0]
+
+    # Generate simulation state object for the file, with the vessel bounds
+    # computed from the vessel motion or read from the corresponding cylinder file
+    if vessel_motion is not None:
+        with timer.stage("read", nbytes=os.path.getsize(particles_file)) as record:
+            simulation_state = ProcessSimulationTimestep(
+                particles_file, cylinder_bounds=vessel_motion.bounds(int(file_name_id)), compact=compact
+                )
+            record["items"] = simulation_state.particles_file.n_points
+    else:
+        cylinder_name = cylinder_prefix + file_name_id +'.vtk'
+        cylinder_file = os.path.join(os.path.dirname(particles_file), cylinder_name)
+
+        # Mesh files may have been thinned out with meshdumpstep, which needs the
+        # analytic vessel motion
+        if not os.path.exists(cylinder_file):
+            raise FileNotFoundError(
+                f"No mesh file {cylinder_file} for {particles_file}. Every dump needs a mesh file when the "
+                f"vessel motion is not computed analytically. If the mesh files were thinned out with "
+                f"meshdumpstep, check that analytic_vessel_motion is True and see the warning above for why "
+                f"the vessel motion failed validation or could not be read")
+
+        with timer.stage("read", nbytes=os.path.getsize(particles_file) + os.path.getsize(cylinder_file)) as record:
+            simulation_state = ProcessSimulationTimestep(particles_file, cylinder_file, compact=compact)
+            record["items"] = simulation_state.particles_file.n_points
+
+    return simulation_state
+
+
+def run_arguments(simulation_state, split_dicts, split_columns):
+    # Arguments of parallel_run for one simulation state
+    save_file = os.path.join(os.path.dirname(simulation_state.filepath), 
+                             f"lacey_{simulation_state.filename}")
+
+    return (simulation_state, save_file, split_dicts, split_columns, mesh_resolution, 
+            mesh_constant, start_rotation, timestep, min_particles, 
+            mesh_column, save_particle_files, field_format, compute_mixing_metrics,
+            n_neighbours, neighbour_sample_size, kernel_threads)
+
+
+def results_columns(study_name):
+    return ["time", 
+            f"{study_name} x lacey",
+            f"{study_name} y lacey",
+            f"{study_name} z lacey",
+            f"{study_name} r lacey",  
+            f"{study_name} in mesh particles",  
+            f"{study_name} out of mesh particles",
+            f"{study_name} dropped particles"]
+
+
+def metrics_columns():
+    return [f"{dimension} {metric}" for dimension in split_dimensions for metric in mixing_metrics]
+
+
+def save_study_metrics(study, times, metrics):
+    metrics_df = pd.DataFrame(metrics, columns=metrics_columns())
+    metrics_df.insert(0, "time", times)
+    metrics_df.to_csv(os.path.join(study, "post", "mixing_metrics.csv"), index=False)
+
+
+def process_study(study, max_workers=None, timer=None):
+    # Calculates the Lacey mixing indices of every particle file in a study folder.
+    # Returns the study results dataframe, or None if no particle files were found.
+    # Stage timings of the main process and the workers are added to `timer` if given
+    timer = timer or StageTimer()
+    study_name = os.path.basename(study)
+
+    # Get all particle files in the study
+    files = study_particle_files(study)
+    
+    if not files:
+        print(f"No particle files found in study: {study_name}")
+        return None
+
+    split_dicts, split_columns, vessel_motion = prepare_study(study, files, timer)
+
+    simulation_state_list = [load_simulation_state(particles_file, vessel_motion, timer) 
+                             for particles_file in files]
+
+    # Arguments for parallel run
+    args = (run_arguments(simulation_state, split_dicts, split_columns) 
+            for simulation_state in simulation_state_list)
+
+    # Workers are spawned rather than forked when called from a thread, e.g. the
+    # on_complete callback of Study.local_launch, as forking a process with other
+    # threads running can deadlock
+    mp_context = None
+    if threading.current_thread() is not threading.main_thread():
+        mp_context = multiprocessing.get_context("spawn")
+
+    # Run parallel processing of files in study
+    with timer.stage("pool"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                                  mp_context=mp_context) as executor:
+        futures = executor.map(parallel_run, *zip(*args))
+        results = []
+        fields = []
+        metrics = []
+        for result, records, field, metric in futures:
+            results.append(result)
+            fields.append(field)
+            metrics.append(metric)
+            timer.extend(records)
+        results = np.array(results)
+
+    if save_study_fields:
+        save_stacked_fields(os.path.join(study, "post", "lacey_concentration_fields.npz"), 
+                            results[:, 0], fields)
+
+    if compute_mixing_metrics:
+        save_study_metrics(study, results[:, 0], metrics)
+
+    # Save parallel run results to dataframe
+    study_df = pd.DataFrame(results, columns=results_columns(study_name))
+
+    return study_df
+
+
+def find_studies():
+    # Returns the study folders to process and the sweep manifest (None if the
+    # sweep has no manifest), leaving out studies with non-zero exit codes
     # Check for exit codes CSV
     exit_codes_file = "non_zero_exit_codes.csv"
     excluded_studies = set()
@@ -88,9 +355,18 @@ def main():
     else:
         print("No exit code CSV file found. Proceeding as normal")
 
-    # study directories 
-    glob_study = os.path.join("../sweep_output", study_format)
-    all_studies = natsorted([f for f in glob.glob(glob_study)])
+    # study directories are read from the sweep manifest, or found by globbing if there is none
+    manifest = sweep_manifest.load_manifest(sweep_dir)
+
+    if manifest is not None:
+        all_studies = [os.path.join(sweep_dir, name) for name in natsorted(manifest["studies"])]
+        excluded_studies.update(name for name, record in manifest["studies"].items()
+                                if record.get("exit_code") not in (None, 0))
+        print(f"Read {len(all_studies)} studies from {sweep_manifest.manifest_path(sweep_dir)}")
+    else:
+        glob_study = os.path.join(sweep_dir, study_format)
+        all_studies = natsorted([f for f in glob.glob(glob_study)])
+        print(f"Looking for pattern: {glob_study}")
     
     # Filter out and print excluded studies
     study_list = []
@@ -102,11 +378,16 @@ def main():
             study_list.append(study)
 
     print(f"Current working directory: {os.getcwd()}")
-    print(f"Looking for pattern: {glob_study}")
     print(f"Found {len(all_studies)} total studies")
     print(f"Processing {len(study_list)} studies after excluding {len(all_studies) - len(study_list)} studies")
     if study_list:
         print("First 5 studies to process:", study_list[:5])
+
+    return study_list, manifest
+
+
+def main():
+    study_list, manifest = find_studies()
     
     # Check if any studies were found
     if not study_list:
@@ -114,64 +395,17 @@ def main():
         return
     
     df = None  # Initialize df 
+    timer = StageTimer()
 
     # Loop over all studies
     for i, study in enumerate(tqdm(study_list)):
-        study_name = os.path.basename(study)
+        study_df = process_study(study, timer=timer)
 
-        # Get all particle files in the study
-        glob_input = os.path.join(study, "post", "particles_*")
-        files = natsorted([f for f in glob.glob(glob_input) if "boundingBox" not in f])
-        
-        if not files:
-            print(f"No particle files found in study: {study_name}")
+        if study_df is None:
             continue
 
-        # Get the split particles for the settled file
-        settled_file = files[round(settled_time/dumpstep)]
-
-        split_dicts = []
-        split_columns = []
-        for split_dimension in split_dimensions:
-            split_dict, split_column = split_particles(settled_file, split_dimension)
-            split_dicts.append(split_dict)
-            split_columns.append(split_column)
-
-        simulation_state_list = []
-        for particles_file in files:
-            # Retrieve corresponding cylinder file for each particle file
-            file_name_id = os.path.basename(particles_file).split("_")[1].split(".")[0]
-            cylinder_name = cylinder_prefix + file_name_id +'.vtk'
-            cylinder_file = os.path.join(os.path.dirname(particles_file), cylinder_name)
-
-            # Generate simulation state object for each file in the study
-            simulation_state = ProcessSimulationTimestep(particles_file, cylinder_file)
-            simulation_state_list.append(simulation_state)
-
-        # Save files list for each study
-        save_file_list = [os.path.join(os.path.dirname(sim.filepath),
-                            f"lacey_{sim.filename}") 
-                            for sim in simulation_state_list]
-
-        # Arguments for parallel run
-        args = ((*inputs, split_dicts, split_columns, mesh_resolution, 
-                mesh_constant, start_rotation, timestep, min_particles, 
-                mesh_column) for inputs in zip(simulation_state_list, save_file_list))
-
-        # Run parallel processing of files in study
-        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-            futures = executor.map(parallel_run, *zip(*args))
-            results = np.array([f for f in futures])
-
-        # Save parallel run results to dataframe
-        study_df = pd.DataFrame(results, columns = ["time", 
-                                                    f"{study_name} x lacey",
-                                                    f"{study_name} y lacey",
-                                                    f"{study_name} z lacey",
-                                                    f"{study_name} r lacey",  
-                                                    f"{study_name} in mesh particles",  
-                                                    f"{study_name} out of mesh particles",
-                                                    f"{study_name} dropped particles"])
+        if manifest is not None:
+            sweep_manifest.update_study(sweep_dir, os.path.basename(study), analysis="done", dumps=len(study_df))
 
         # Merge all study dataframes
         if df is None:
@@ -186,5 +420,11 @@ def main():
     else:
         print("No data was processed, no CSV file was created")
 
+    if timer.records:
+        summary = print_timing_summary(timer.records)
+        summary.to_csv(timing_summary_file)
+        write_trace(timer.records, timing_trace_file)
+        print(f"Timings saved to {timing_summary_file} and {timing_trace_file}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,133 @@
+import numpy as np
+
+# Numba is optional, the NumPy implementations are used when it is not installed
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def cell_bounds_index(bounds, value):
+
+    # Index i of the interval bounds[i] <= value < bounds[i+1], or -1 outside the bounds
+    index = np.searchsorted(bounds, value, side="right") - 1
+    return np.where((index >= 0) & (index < len(bounds) - 1), index, -1)
+
+
+def bin_and_count_numpy(points, x_center, y_center, start_rotation,
+                        angular_bounds, radial_bounds, z_bounds, classes):
+
+    n_ang = len(angular_bounds) - 1
+    n_rad = len(radial_bounds) - 1
+    n_cells = n_ang * n_rad * (len(z_bounds) - 1)
+
+    dx = points[:, 0] - x_center
+    dy = points[:, 1] - y_center
+
+    angles = (np.arctan2(dy, dx) + np.pi + start_rotation) % (2*np.pi)
+    radii = np.sqrt(dx**2 + dy**2)
+
+    ang_index = cell_bounds_index(angular_bounds, angles)
+    rad_index = cell_bounds_index(radial_bounds, radii)
+    z_index = cell_bounds_index(z_bounds, points[:, 2])
+
+    in_mesh = (ang_index >= 0) & (rad_index >= 0) & (z_index >= 0)
+    cell_ids = np.where(in_mesh, z_index*n_rad*n_ang + rad_index*n_ang + ang_index, -1)
+
+    totals = np.bincount(cell_ids[in_mesh], minlength=n_cells)
+    class_1_counts = np.zeros((len(classes), n_cells), dtype=np.int64)
+    for i, particle_class in enumerate(classes):
+        class_1_counts[i] = np.bincount(cell_ids[in_mesh & particle_class], minlength=n_cells)
+
+    return cell_ids, totals, class_1_counts
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def bin_and_count_numba(points, x_center, y_center, start_rotation,
+                            angular_bounds, radial_bounds, z_bounds, classes, n_chunks):
+
+        # Single pass over the particles: the cylindrical transform, cell assignment
+        # and per-cell counts are computed without full length temporaries. Each
+        # thread counts its own chunk of particles into a separate row, which are
+        # summed at the end to avoid race conditions
+        n_points = points.shape[0]
+        n_splits = classes.shape[0]
+        n_ang = len(angular_bounds) - 1
+        n_rad = len(radial_bounds) - 1
+        n_z = len(z_bounds) - 1
+        n_cells = n_ang * n_rad * n_z
+
+        chunk_size = (n_points + n_chunks - 1) // n_chunks
+
+        cell_ids = np.empty(n_points, dtype=np.int64)
+        chunk_totals = np.zeros((n_chunks, n_cells), dtype=np.int64)
+        chunk_class_1 = np.zeros((n_chunks, n_splits, n_cells), dtype=np.int64)
+
+        for chunk in numba.prange(n_chunks):
+            for p in range(chunk * chunk_size, min((chunk + 1) * chunk_size, n_points)):
+                dx = points[p, 0] - x_center
+                dy = points[p, 1] - y_center
+
+                angle = (np.arctan2(dy, dx) + np.pi + start_rotation) % (2*np.pi)
+                radius = np.sqrt(dx**2 + dy**2)
+
+                j = np.searchsorted(angular_bounds, angle, side="right") - 1
+                i = np.searchsorted(radial_bounds, radius, side="right") - 1
+                k = np.searchsorted(z_bounds, points[p, 2], side="right") - 1
+
+                if 0 <= j < n_ang and 0 <= i < n_rad and 0 <= k < n_z:
+                    cell = k*n_rad*n_ang + i*n_ang + j
+                    cell_ids[p] = cell
+                    chunk_totals[chunk, cell] += 1
+                    for s in range(n_splits):
+                        if classes[s, p]:
+                            chunk_class_1[chunk, s, cell] += 1
+                else:
+                    cell_ids[p] = -1
+
+        return cell_ids, chunk_totals.sum(axis=0), chunk_class_1.sum(axis=0)
+
+
+def set_num_threads(n_threads):
+
+    # Threads used by the parallel Numba kernel in this process. Worker processes
+    # of a pool that already has a worker per core should use 1
+    if numba is not None:
+        numba.set_num_threads(n_threads)
+
+
+def bin_and_count(points, x_center, y_center, start_rotation,
+                  angular_bounds, radial_bounds, z_bounds, classes=None, use_numba=True):
+
+    # Assigns each particle to a cylindrical mesh cell (numbered z, then radial, then
+    # angular as in `mesh_particles`, -1 outside the mesh) and counts the particles
+    # per cell. `classes` is an optional (n_splits, n_particles) boolean array, for
+    # which the class 1 particles per cell are also counted.
+    # Returns the cell ids, particles per cell and class 1 particles per cell
+    points = np.ascontiguousarray(points)
+    if classes is None:
+        classes = np.zeros((0, len(points)), dtype=bool)
+    classes = np.ascontiguousarray(classes, dtype=bool)
+
+    args = (points, float(x_center), float(y_center), float(start_rotation),
+            np.asarray(angular_bounds, dtype=np.float64),
+            np.asarray(radial_bounds, dtype=np.float64),
+            np.asarray(z_bounds, dtype=np.float64),
+            classes)
+
+    if use_numba and numba is not None:
+        return bin_and_count_numba(*args, numba.get_num_threads())
+
+    return bin_and_count_numpy(*args)
+
+
+def count_cells(cell_ids, particle_class, n_cells):
+
+    # Particles and class 1 particles per cell for particles with known cell ids
+    in_mesh = cell_ids >= 0
+    totals = np.bincount(cell_ids[in_mesh], minlength=n_cells)
+    class_1_counts = np.bincount(cell_ids[in_mesh & particle_class], minlength=n_cells)
+
+    return totals, class_1_counts
@@ -0,0 +1,107 @@
+import os
+import time
+import json
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+
+
+class StageTimer():
+
+    def __init__(self):
+
+        # One record per timed stage: name, wall clock start, duration, process,
+        # number of particles handled and number of bytes read or written
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, items=0, nbytes=0):
+
+        # time.time() gives start times comparable between worker processes,
+        # perf_counter() the precise duration
+        start = time.time()
+        counter = time.perf_counter()
+
+        record = {"stage": name, "start": start, "duration": 0.0,
+                  "pid": os.getpid(), "items": items, "bytes": nbytes}
+
+        try:
+            yield record
+        finally:
+            record["duration"] = time.perf_counter() - counter
+            self.records.append(record)
+
+    def extend(self, records):
+        self.records.extend(records)
+
+
+def summarise_stages(records):
+
+    # Total time, throughput and share of busy time per stage
+    df = pd.DataFrame(records, columns=["stage", "start", "duration", "pid", "items", "bytes"])
+    pool_stages = df["stage"] == "pool"
+    stages = df[~pool_stages]
+
+    summary = stages.groupby("stage", sort=False).agg(calls=("duration", "size"),
+                                                      total_s=("duration", "sum"),
+                                                      items=("items", "sum"),
+                                                      bytes=("bytes", "sum"))
+
+    summary["mean_ms"] = 1e3 * summary["total_s"] / summary["calls"]
+    summary["share_%"] = 100 * summary["total_s"] / summary["total_s"].sum()
+    summary["particles_per_s"] = summary["items"] / summary["total_s"]
+    summary["MB_per_s"] = summary["bytes"] / 1e6 / summary["total_s"]
+
+    return summary
+
+
+def worker_utilisation(records):
+
+    # Fraction of the wall time of its process pool each worker process spent
+    # busy. Every study (or shard) creates its own pool, so each worker's records
+    # are attributed to the pool that was running when they started
+    df = pd.DataFrame(records, columns=["stage", "start", "duration", "pid", "items", "bytes"])
+    pools = df[df["stage"] == "pool"].sort_values("start")
+    main_pid = os.getpid()
+
+    workers = df[(df["stage"] != "pool") & (df["pid"] != main_pid)].copy()
+    workers["pool"] = np.searchsorted(pools["start"].values, workers["start"].values, side="right") - 1
+    workers = workers[workers["pool"] >= 0]
+
+    busy = workers.groupby("pid")["duration"].sum()
+    pool_time = workers.groupby("pid")["pool"].agg(lambda pool: pools["duration"].values[pool.unique()].sum())
+
+    return (busy / pool_time.where(pool_time > 0)).fillna(0)
+
+
+def print_timing_summary(records):
+
+    summary = summarise_stages(records)
+    utilisation = worker_utilisation(records)
+
+    print("Stage timings:")
+    print(summary[["calls", "total_s", "mean_ms", "share_%", "particles_per_s", "MB_per_s"]]
+          .round(2).to_string())
+
+    if len(utilisation):
+        print(f"Worker utilisation: mean {100 * utilisation.mean():.1f}%, "
+              f"min {100 * utilisation.min():.1f}%, max {100 * utilisation.max():.1f}% "
+              f"over {len(utilisation)} workers")
+
+    return summary
+
+
+def write_trace(records, trace_file):
+
+    # Chrome trace event format, viewable in chrome://tracing or https://ui.perfetto.dev
+    events = [{"name": record["stage"],
+               "ph": "X",
+               "ts": 1e6 * record["start"],
+               "dur": 1e6 * record["duration"],
+               "pid": record["pid"],
+               "tid": record["pid"],
+               "args": {"items": record["items"], "bytes": record["bytes"]}}
+              for record in records]
+
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
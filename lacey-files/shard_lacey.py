@@ -0,0 +1,245 @@
+import os
+import sys
+import glob
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import calculate_lacey as cl
+from calculate_lacey import parallel_run, sweep_manifest
+from pipeline_timing import StageTimer, print_timing_summary, write_trace
+
+
+# Partial results of each shard, merged into the results of calculate_lacey.py
+shard_dir = "lacey_shards"
+
+
+def shard_rank():
+    # The shard index and number of shards of this process, from MPI if mpi4py
+    # is installed and there is more than one rank, otherwise from the SLURM
+    # array task, otherwise a single shard
+    try:
+        from mpi4py import MPI
+        if MPI.COMM_WORLD.Get_size() > 1:
+            return MPI.COMM_WORLD.Get_rank(), MPI.COMM_WORLD.Get_size()
+    except ImportError:
+        pass
+
+    if "SLURM_ARRAY_TASK_ID" in os.environ:
+        task_min = int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        return (int(os.environ["SLURM_ARRAY_TASK_ID"]) - task_min,
+                int(os.environ["SLURM_ARRAY_TASK_COUNT"]))
+
+    return 0, 1
+
+
+def shard_tasks(study_list, shard, n_shards):
+    # Every (study, particle file) task of the sweep, in a fixed order so every
+    # shard agrees on it, split into contiguous blocks of about the same total
+    # particle file size. Each shard then covers only a few whole studies, so
+    # few studies are prepared on more than one shard, and studies with more
+    # particles are spread over more shards
+    tasks = [(study, particles_file) for study in study_list
+             for particles_file in cl.study_particle_files(study)]
+
+    if not tasks:
+        return []
+
+    # Each task goes to the shard holding the middle of its bytes
+    sizes = np.array([os.path.getsize(particles_file) for _, particles_file in tasks], dtype=float)
+    midpoints = np.cumsum(sizes) - sizes / 2
+    task_shards = np.minimum((midpoints / max(sizes.sum(), 1) * n_shards).astype(int), n_shards - 1)
+
+    return [task for task, task_shard in zip(tasks, task_shards) if task_shard == shard]
+
+
+def shard_arguments(study_tasks, timer):
+    # Arguments of parallel_run for every task of the shard, study by study,
+    # after the particle classes and vessel motion of each study are found from
+    # the same settled file and mesh files as on every other shard
+    for study, files in study_tasks.items():
+        split_dicts, split_columns, vessel_motion = cl.prepare_study(study, cl.study_particle_files(study), timer)
+
+        for particles_file in files:
+            yield study, cl.run_arguments(cl.load_simulation_state(particles_file, vessel_motion, timer),
+                                          split_dicts, split_columns)
+
+
+def shard_file(shard, n_shards):
+    return os.path.join(shard_dir, f"shard_{shard:04d}-of-{n_shards:04d}.csv")
+
+
+def run_shard(shard, n_shards, max_workers=None, timer=None):
+    # Calculates the Lacey mixing indices (and mixing metrics) of the tasks of one
+    # shard, written in long format (one row per dump) to its shard file
+    timer = timer or StageTimer()
+    study_list, _ = cl.find_studies()
+    tasks = shard_tasks(study_list, shard, n_shards)
+    print(f"Shard {shard + 1}/{n_shards}: {len(tasks)} dumps")
+
+    study_tasks = {}
+    for study, particles_file in tasks:
+        study_tasks.setdefault(study, []).append(particles_file)
+
+    rows = []
+    pending = {}
+    max_workers = max_workers or os.cpu_count()
+
+    def collect(futures):
+        for future in futures:
+            result, records, _, metric = future.result()
+            rows.append([os.path.basename(pending.pop(future)), *result, *(metric or [])])
+            timer.extend(records)
+
+    # Dumps are submitted across study boundaries so every worker stays busy,
+    # with at most two dumps per worker read ahead of the workers
+    with timer.stage("pool"), ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for study, args in shard_arguments(study_tasks, timer):
+            pending[executor.submit(parallel_run, *args)] = study
+
+            if len(pending) >= 2 * max_workers:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+        collect(list(pending))
+
+    columns = ["study", "time", "x lacey", "y lacey", "z lacey", "r lacey",
+               "in mesh particles", "out of mesh particles", "dropped particles"]
+    if cl.compute_mixing_metrics:
+        columns += cl.metrics_columns()
+
+    # Written to a temporary file first, so an incomplete shard file is never merged
+    os.makedirs(shard_dir, exist_ok=True)
+    save_file = shard_file(shard, n_shards)
+    pd.DataFrame(rows, columns=columns).to_csv(save_file + ".tmp", index=False)
+    os.replace(save_file + ".tmp", save_file)
+    print(f"Shard results saved to {save_file}")
+
+    return timer
+
+
+def merge_shards(allow_partial=False):
+    # Merges the shard files into lacey_results.csv, in the same wide format as
+    # calculate_lacey.py, and the mixing metrics of each study. Refuses to merge
+    # if any shard file is missing unless allow_partial, and only marks studies
+    # with every dump merged as analysed in the sweep manifest
+    shard_files = natsorted(glob.glob(os.path.join(shard_dir, "shard_*-of-*.csv")))
+    if not shard_files:
+        print(f"No shard files found in {shard_dir}")
+        return None
+
+    n_shards = {int(f.split("-of-")[1].split(".")[0]) for f in shard_files}
+    if len(n_shards) > 1:
+        raise Exception(f"Shard files of different runs found in {shard_dir}: {n_shards}")
+
+    n_shards = n_shards.pop()
+    missing = [shard for shard in range(n_shards) if not os.path.exists(shard_file(shard, n_shards))]
+    if missing:
+        if not allow_partial:
+            raise Exception(f"Missing results of shards {missing} in {shard_dir}. Rerun those shards, or merge "
+                            f"with --allow-partial to leave their dumps out")
+        print(f"Warning: missing results of shards {missing}, their dumps are left out")
+
+    results = pd.concat([pd.read_csv(f) for f in shard_files], ignore_index=True)
+    if results.empty:
+        raise Exception(f"No results found in the shard files in {shard_dir}")
+
+    manifest = sweep_manifest.load_manifest(cl.sweep_dir)
+    lacey_columns = ["time", "x lacey", "y lacey", "z lacey", "r lacey",
+                     "in mesh particles", "out of mesh particles", "dropped particles"]
+
+    df = None
+    for study_name in natsorted(results["study"].unique()):
+        study_results = results[results["study"] == study_name].sort_values("time")
+        study_df = pd.DataFrame(study_results[lacey_columns].values, columns=cl.results_columns(study_name))
+
+        if cl.compute_mixing_metrics and set(cl.metrics_columns()) <= set(study_results.columns):
+            cl.save_study_metrics(os.path.join(cl.sweep_dir, study_name), study_results["time"].values,
+                                  study_results[cl.metrics_columns()].values)
+
+        # Studies with dumps in a missing shard are recorded as partially analysed
+        n_dumps = len(cl.study_particle_files(os.path.join(cl.sweep_dir, study_name)))
+        complete = len(study_df) >= n_dumps
+        if not complete:
+            print(f"Warning: only {len(study_df)} of {n_dumps} dumps of {study_name} merged")
+
+        if manifest is not None:
+            sweep_manifest.update_study(cl.sweep_dir, study_name, analysis="done" if complete else "partial",
+                                        dumps=len(study_df))
+
+        # Merge all study dataframes
+        if df is None:
+            df = study_df
+        else:
+            df = df.merge(study_df, how="outer", on="time")
+
+    df.to_csv("lacey_results.csv")
+    print(f"Merged {len(shard_files)} shards into lacey_results.csv")
+
+    return df
+
+
+def run_local(n_shards, max_workers=None, allow_partial=False):
+    # Runs every shard as a separate process on this machine, standing in for
+    # the nodes of a multi-node run, then merges their results if every shard
+    # succeeded (or allow_partial)
+    workers = max_workers or max(1, (os.cpu_count() or 1) // n_shards)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "run",
+                                   "--shard", str(shard), "--shards", str(n_shards),
+                                   "--workers", str(workers)])
+                 for shard in range(n_shards)]
+
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        if not allow_partial:
+            raise Exception(f"Shards {failed} failed, not merging. Rerun them with `run --shard`, or merge "
+                            f"with --allow-partial to leave their dumps out")
+        print(f"Warning: shards {failed} failed")
+
+    return merge_shards(allow_partial)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded Lacey post-processing over several nodes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Process the dumps of one shard")
+    run_parser.add_argument("--shard", type=int, default=None,
+                            help="shard index, from MPI or SLURM_ARRAY_TASK_ID if not given")
+    run_parser.add_argument("--shards", type=int, default=None, help="number of shards")
+    run_parser.add_argument("--workers", type=int, default=None, help="worker processes per shard")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge the shard results into lacey_results.csv")
+    merge_parser.add_argument("--allow-partial", action="store_true",
+                              help="merge even if some shard results are missing")
+
+    local_parser = subparsers.add_parser("local", help="Run all shards as local processes, then merge")
+    local_parser.add_argument("--shards", type=int, required=True, help="number of shards")
+    local_parser.add_argument("--workers", type=int, default=None, help="worker processes per shard")
+    local_parser.add_argument("--allow-partial", action="store_true", help="merge even if some shards failed")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        shard, n_shards = shard_rank()
+        shard = shard if args.shard is None else args.shard
+        n_shards = n_shards if args.shards is None else args.shards
+
+        timer = run_shard(shard, n_shards, args.workers)
+
+        if timer.records:
+            base = os.path.join(shard_dir, f"shard_{shard:04d}")
+            print_timing_summary(timer.records).to_csv(f"{base}_{cl.timing_summary_file}")
+            write_trace(timer.records, f"{base}_{cl.timing_trace_file}")
+
+    elif args.command == "merge":
+        merge_shards(args.allow_partial)
+
+    else:
+        run_local(args.shards, args.workers, args.allow_partial)
+
+
+if __name__ == "__main__":
+    main()
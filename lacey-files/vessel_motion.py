@@ -0,0 +1,148 @@
+import re
+import os
+import glob
+import warnings
+import numpy as np
+import pyvista as pv
+from natsort import natsorted
+
+
+# LIGGGHTS input lines used to follow the motion of the vessel mesh
+VARIABLE = re.compile(r"^variable\s+(\w+)\s+equal\s+(.+)$")
+WIGGLE = re.compile(r"^fix\s+(\w+)\s+.*\bmove/mesh\b.*\bwiggle\s+amplitude\s+(\S+)\s+(\S+)\s+(\S+)\s+period\s+(\S+)")
+UNFIX = re.compile(r"^unfix\s+(\w+)")
+RUN = re.compile(r"^run\s+(\S+)")
+
+
+def _evaluate(expression, variables):
+
+    # Substitute ${name}, $name and v_name references to earlier variables, then
+    # evaluate the remaining arithmetic, as LIGGGHTS does for "equal" variables
+    expression = re.sub(r"\$\{(\w+)\}|\$(\w)|\bv_(\w+)",
+                        lambda m: repr(variables[m.group(1) or m.group(2) or m.group(3)]),
+                        expression)
+    expression = expression.replace("$(", "(")
+
+    if not re.fullmatch(r"[\d\s.eE+\-*/()^]+", expression):
+        raise ValueError(f"Cannot evaluate LIGGGHTS expression '{expression}'")
+
+    return float(eval(expression.replace("^", "**"), {"__builtins__": {}}))
+
+
+def read_vessel_motion(sim_file):
+
+    # Follow the run commands of a LIGGGHTS input script to find the steps
+    # between which each `fix move/mesh ... wiggle` is active, with its
+    # amplitude (x, y, z) and period. Returns the timestep and the list of
+    # wiggles as (start_step, end_step, amplitude, period), end_step None if the
+    # fix is never removed
+    variables = {}
+    wiggles = {}
+    motions = []
+    step = 0
+
+    with open(sim_file) as f:
+        for line in f:
+            # Strip comments
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+
+            if (match := VARIABLE.match(line)):
+                variables[match.group(1)] = _evaluate(match.group(2), variables)
+
+            elif (match := WIGGLE.match(line)):
+                amplitude = np.array([_evaluate(a, variables) for a in match.group(2, 3, 4)])
+                wiggles[match.group(1)] = (step, amplitude, _evaluate(match.group(5), variables))
+
+            elif (match := UNFIX.match(line)) and match.group(1) in wiggles:
+                start_step, amplitude, period = wiggles.pop(match.group(1))
+                motions.append((start_step, step, amplitude, period))
+
+            elif (match := RUN.match(line)):
+                step += int(round(_evaluate(match.group(1), variables)))
+
+    motions.extend((start_step, None, amplitude, period) for start_step, amplitude, period in wiggles.values())
+
+    return variables["timestep"], motions
+
+
+def vessel_offset(step, timestep, motions):
+
+    # Displacement of the vessel at a dump step. A wiggle moves the mesh by
+    # amplitude * sin(2 pi t / period), t the time since the fix was created,
+    # and the mesh stays where it is once the fix is removed
+    offset = np.zeros(3)
+
+    for start_step, end_step, amplitude, period in motions:
+        if step <= start_step:
+            continue
+
+        moving_steps = step - start_step if end_step is None else min(step, end_step) - start_step
+        offset += amplitude * np.sin(2 * np.pi * moving_steps * timestep / period)
+
+    return offset
+
+
+def offset_bounds(bounds, offset):
+    return np.asarray(bounds, dtype=float) + np.repeat(offset, 2)
+
+
+class VesselMotion():
+
+    def __init__(self, sim_file, reference_file):
+
+        # The vessel bounds at any dump are the bounds of a reference mesh file
+        # moved by the difference in the analytical offset, so only a few mesh
+        # files need to be written by LIGGGHTS and read here
+        self.timestep, self.motions = read_vessel_motion(sim_file)
+
+        reference_step = int(os.path.basename(reference_file).split("_")[1].split(".")[0])
+        self.rest_bounds = offset_bounds(pv.read(reference_file).bounds,
+                                         -vessel_offset(reference_step, self.timestep, self.motions))
+
+    def bounds(self, step):
+        return offset_bounds(self.rest_bounds, vessel_offset(step, self.timestep, self.motions))
+
+    def validate(self, mesh_files, tolerance=1e-5):
+
+        # Largest difference between the predicted and written bounds of the
+        # given mesh files, and whether it is within the tolerance (in metres)
+        error = 0.0
+        for mesh_file in mesh_files:
+            step = int(os.path.basename(mesh_file).split("_")[1].split(".")[0])
+            error = max(error, np.max(np.abs(self.bounds(step) - np.asarray(pv.read(mesh_file).bounds))))
+
+        return error, error <= tolerance
+
+
+def study_vessel_motion(study, sim_name="resodyn.sim", cylinder_prefix="mesh_", n_validate=5, tolerance=1e-5):
+
+    # Vessel motion of a study, validated against its first mesh files. Returns
+    # None, with a warning, if the motion cannot be computed or does not match
+    # the mesh files, in which case the mesh file of every dump must be read
+    sim_file = os.path.join(study, sim_name)
+    mesh_files = natsorted(glob.glob(os.path.join(study, "post", f"{cylinder_prefix}*.vtk")))
+
+    if not os.path.exists(sim_file) or not mesh_files:
+        warnings.warn(f"No {sim_name} or mesh files in {study}, cannot compute the vessel motion")
+        return None
+
+    try:
+        motion = VesselMotion(sim_file, mesh_files[0])
+    except (KeyError, ValueError) as e:
+        warnings.warn(f"Could not read the vessel motion from {sim_file}: {e}")
+        return None
+
+    # Validate against the mesh files written while the vessel moves if there are
+    # any, as the rest of the mesh files match for any motion
+    moving_files = [mesh_file for mesh_file in mesh_files
+                    if np.any(vessel_offset(int(os.path.basename(mesh_file).split("_")[1].split(".")[0]),
+                                            motion.timestep, motion.motions))]
+
+    error, valid = motion.validate((moving_files or mesh_files)[:n_validate], tolerance)
+    if not valid:
+        warnings.warn(f"Vessel motion of {study} differs from its mesh files by {error:.3g} m")
+        return None
+
+    return motion
@@ -1,7 +1,11 @@
 import os
+import sys
 import pyvista as pv
 import csv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "study-setup"))
+import sweep_manifest
+
 def check_vtk_files_in_post_folder(post_folder_path, invalid_files_list):
     valid_files = 0
     invalid_files = 0
@@ -52,8 +56,18 @@ def process_simulation_folders(root_folder, output_folder):
         # List to store invalid VTK files 
         invalid_files_list = []
 
+        # Simulation folders are read from the sweep manifest, or listed if there is none
+        manifest_folders = sweep_manifest.list_studies(root_folder)
+        if manifest_folders is not None:
+            simulation_folders = [os.path.basename(folder) for folder in manifest_folders]
+        else:
+            simulation_folders = os.listdir(root_folder)
+
+        # Valid and invalid VTK counts recorded in the manifest
+        manifest_updates = {}
+
         # Go through through each simulation folder in the root folder
-        for simulation_folder in os.listdir(root_folder):
+        for simulation_folder in simulation_folders:
             simulation_path = os.path.join(root_folder, simulation_folder)
 
             if os.path.isdir(simulation_path):
@@ -76,6 +90,8 @@ def process_simulation_folders(root_folder, output_folder):
                         "Valid Fraction": valid_fraction,
                         "Total VTKs": total_count
                     })
+
+                    manifest_updates[simulation_folder] = {"valid_dumps": valid_count, "invalid_dumps": invalid_count}
                 else:
                     print(f"Warning: 'post' folder not found in {simulation_folder}")
 
@@ -87,6 +103,9 @@ def process_simulation_folders(root_folder, output_folder):
                 invalid_writer.writeheader()
                 invalid_writer.writerows(invalid_files_list)
 
+        if manifest_folders is not None and manifest_updates:
+            sweep_manifest.update_studies(root_folder, manifest_updates)
+
     print(f"Results saved to {output_csv} and {invalid_csv}")
 
 
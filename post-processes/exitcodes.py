@@ -1,8 +1,12 @@
 import os
+import sys
 import glob
 import csv
 from collections import defaultdict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "study-setup"))
+import sweep_manifest
+
 DL = 75 # Output delimiter length (for visual ease of reading output)
 
 base_dir = "../sweep_output"
@@ -17,8 +21,17 @@ exit_code_counts = defaultdict(int)
 vtk_file_counts = defaultdict(int)
 non_zero_exit_codes = []
 
+# Studies are read from the sweep manifest, or found by globbing if there is none
+study_folders = sweep_manifest.list_studies(base_dir)
+has_manifest = study_folders is not None
+if not has_manifest:
+    study_folders = glob.glob(os.path.join(base_dir, study_format))
+
+# Exit codes and dump counts recorded in the manifest
+manifest_updates = {}
+
 # Iterate through all studies
-for folder in glob.glob(os.path.join(base_dir, study_format)):
+for folder in study_folders:
 
     if os.path.isdir(folder):
 
@@ -43,6 +56,9 @@ for folder in glob.glob(os.path.join(base_dir, study_format)):
                     
                     if exit_code is not None:
                         exit_code_counts[exit_code] += 1
+
+                        manifest_updates.setdefault(os.path.basename(folder), {}).update(
+                            exit_code=int(exit_code), status="finished" if exit_code == "0" else "failed")
                         
                         # Add to the list if exit code is non-zero
                         if exit_code != "0":
@@ -58,6 +74,11 @@ for folder in glob.glob(os.path.join(base_dir, study_format)):
 
             vtk_file_counts[num_vtk_files] += 1
 
+            manifest_updates.setdefault(os.path.basename(folder), {})["dumps"] = len(
+                [f for f in vtk_files if os.path.basename(f).startswith("particles_")])
+
+if has_manifest and manifest_updates:
+    sweep_manifest.update_studies(base_dir, manifest_updates)
 
 csv_file_path = os.path.join(output_dir, "non_zero_exit_codes.csv")
 
@@ -46,7 +46,132 @@ def fit_lacey_data(lacey_data: np.ndarray, time: np.ndarray) -> tuple[float, flo
     return k, r_squared, rmse
 
 
-def build_k_df(filtered_df: pd.DataFrame) -> pd.DataFrame:
+def fit_lacey_batch(lacey_data: np.ndarray,
+                    time: np.ndarray,
+                    A: np.ndarray,
+                    k0: float | np.ndarray = 0.1,
+                    max_iter: int = 100,
+                    tol: float = 1e-8) -> np.ndarray:
+    # Fits k for every row of `lacey_data` at once with a vectorised
+    # Levenberg-Marquardt iteration. `lacey_data` has shape (n_fits, n_times),
+    # `time` is either shared (n_times,) or per fit (n_fits, n_times) and A is
+    # the fixed plateau of each fit (n_fits,). k0 is a scalar or per fit guess
+    lacey_data = np.atleast_2d(np.asarray(lacey_data, dtype=float))
+    time = np.broadcast_to(np.asarray(time, dtype=float), lacey_data.shape)
+    A = np.broadcast_to(np.asarray(A, dtype=float), lacey_data.shape[:1])[:, None]
+
+    k = np.broadcast_to(np.asarray(k0, dtype=float), lacey_data.shape[:1]).copy()
+
+    # Only the fits that have not converged are iterated on
+    active = np.arange(lacey_data.shape[0])
+    y, t, A_active, k_active = lacey_data, time, A, k.copy()
+    damping = np.full(active.size, 1e-3)
+
+    decay = np.exp(-k_active[:, None] * t)
+    residuals = y - A_active * (1 - decay)
+    sse = np.sum(residuals ** 2, axis=1)
+
+    for _ in range(max_iter):
+        jacobian = A_active * t * decay
+
+        gradient = np.sum(jacobian * residuals, axis=1)
+        curvature = np.sum(jacobian ** 2, axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = gradient / (curvature * (1 + damping))
+        step[~np.isfinite(step)] = 0.0
+
+        trial_k = k_active + step
+        trial_decay = np.exp(-trial_k[:, None] * t)
+        trial_residuals = y - A_active * (1 - trial_decay)
+        trial_sse = np.sum(trial_residuals ** 2, axis=1)
+
+        # Accept steps that reduce the error, otherwise increase the damping
+        improved = trial_sse <= sse
+        k_active[improved] = trial_k[improved]
+        decay[improved] = trial_decay[improved]
+        residuals[improved] = trial_residuals[improved]
+        sse[improved] = trial_sse[improved]
+        damping = np.where(improved, damping / 10, damping * 10)
+
+        converged = improved & (np.abs(step) <= tol * (np.abs(k_active) + tol))
+        done = converged | (damping > 1e10)
+        k[active[done]] = k_active[done]
+
+        if done.all():
+            break
+
+        keep = ~done
+        active, y, t, A_active = active[keep], y[keep], t[keep], A_active[keep]
+        k_active, damping, decay = k_active[keep], damping[keep], decay[keep]
+        residuals, sse = residuals[keep], sse[keep]
+    else:
+        k[active] = k_active
+
+    return k
+
+
+def bootstrap_lacey_fit(lacey_data: np.ndarray,
+                        time: np.ndarray,
+                        n_bootstrap: int = 1000,
+                        method: str = "residuals",
+                        confidence: float = 0.95,
+                        seed: int | None = None,
+                        chunk_size: int = 200_000) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Bootstraps the fitted k of every row of `lacey_data` (n_fits, n_times).
+    # "residuals" resamples the residuals of the point fit onto the fitted
+    # curve, keeping its plateau A. "time" resamples (t, lacey) pairs and
+    # re-estimates A as the maximum of each resample, as in `fit_lacey_data`.
+    # Returns the point estimates and the lower and upper confidence bounds.
+    lacey_data = np.atleast_2d(np.asarray(lacey_data, dtype=float))
+    time = np.asarray(time, dtype=float)
+    n_fits, n_times = lacey_data.shape
+
+    if method not in ("residuals", "time"):
+        raise ValueError(f"{method} is not a recognised bootstrap method")
+
+    A = np.max(lacey_data, axis=1)
+    k = fit_lacey_batch(lacey_data, time, A)
+    y_pred = model(time, k[:, None], A[:, None])
+    residuals = lacey_data - y_pred
+    residuals -= residuals.mean(axis=1, keepdims=True)
+
+    rng = np.random.default_rng(seed)
+    k_samples = np.empty((n_fits, n_bootstrap))
+
+    # Bound the size of the (fits x replicates x times) work arrays
+    replicates_per_chunk = max(1, chunk_size // max(1, n_fits * n_times))
+
+    for start in range(0, n_bootstrap, replicates_per_chunk):
+        n_reps = min(replicates_per_chunk, n_bootstrap - start)
+        indices = rng.integers(0, n_times, size=(n_fits, n_reps, n_times))
+
+        if method == "residuals":
+            resampled = (y_pred[:, None, :]
+                         + np.take_along_axis(residuals[:, None, :], indices, axis=2))
+            resampled_time = time
+            resampled_A = np.repeat(A, n_reps)
+        else:
+            resampled = np.take_along_axis(lacey_data[:, None, :], indices, axis=2)
+            resampled_time = time[indices].reshape(-1, n_times)
+            resampled_A = np.max(resampled, axis=2).ravel()
+
+        # Replicates start from their point estimate so few iterations are needed
+        resampled = resampled.reshape(-1, n_times)
+        k_boot = fit_lacey_batch(resampled, resampled_time, resampled_A, k0=np.repeat(k, n_reps))
+        k_samples[:, start:start + n_reps] = k_boot.reshape(n_fits, n_reps)
+
+    alpha = (1 - confidence) / 2
+    k_low, k_high = np.nanquantile(k_samples, [alpha, 1 - alpha], axis=1)
+
+    return k, k_low, k_high
+
+
+def build_k_df(filtered_df: pd.DataFrame,
+               n_bootstrap: int = 0,
+               bootstrap_method: str = "residuals",
+               confidence: float = 0.95,
+               seed: int | None = None) -> pd.DataFrame:
     new_data = []
 
     # Get a list of lacey columns in the filtered DataFrame
@@ -89,16 +214,38 @@ def build_k_df(filtered_df: pd.DataFrame) -> pd.DataFrame:
     columns.extend([f"k{dim} RMSE" for dim in dimensions])
     
     new_df = pd.DataFrame(new_data, columns=columns)
-    
+
+    # Confidence intervals for every study and split are bootstrapped in one batch
+    if n_bootstrap > 0:
+        time = filtered_df.iloc[:, 0].values
+        lacey_data = filtered_df[lacey_columns].values.T
+
+        _, k_low, k_high = bootstrap_lacey_fit(lacey_data, time, n_bootstrap,
+                                               bootstrap_method, confidence, seed)
+
+        for j, dim in enumerate(dimensions):
+            new_df[f"{dim} lacey k CI low"] = k_low[j::4]
+            new_df[f"{dim} lacey k CI high"] = k_high[j::4]
+
     return new_df
 
 
-lacey_results_path = "../lacey-files/lacye_results.csv"
+def main():
+    lacey_results_path = "../lacey-files/lacye_results.csv"
+
+    # Number of bootstrap replicates for the k confidence intervals (0 disables)
+    n_bootstrap = 1000
+    bootstrap_method = "residuals"  # "residuals" or "time"
+    confidence = 0.95
+
+    df = pd.read_csv(lacey_results_path)
+    filtered_df = filter_df(df)
+    new_df = build_k_df(filtered_df, n_bootstrap, bootstrap_method, confidence, seed=0)
+    print(f"Fitted k-values DataFrame created with shape {new_df.shape}")
+
+    new_df.to_csv("fitted_k_values.csv", index=False)
+    print("Fitted k-values saved to 'fitted_k_values.csv'")
 
-df = pd.read_csv(lacey_results_path)
-filtered_df = filter_df(df)
-new_df = build_k_df(filtered_df)
-print(f"Fitted k-values DataFrame created with shape {new_df.shape}")
 
-new_df.to_csv("fitted_k_values.csv", index=False)
-print("Fitted k-values saved to 'fitted_k_values.csv'")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import fnmatch
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from lacey_fitting import model, fit_lacey_batch
+from lacey_sensitivity import parse_study_name
+
+
+DIMENSIONS = ["x", "y", "z", "r"]
+COLOURS = {"x": "r", "y": "b", "z": "g", "r": "k"}
+
+# Fitting starts at t = 2, as in lacey_fitting.py
+FIT_START = 2
+
+
+def read_results(results_path: str,
+                 studies: str | list[str] | None = None,
+                 dimensions: list[str] = DIMENSIONS,
+                 t_min: float | None = None) -> tuple[pd.DataFrame, list[str]]:
+    # Reads only the time and Lacey columns of the selected studies from the wide
+    # lacey_results.csv. `studies` is a list of study names or a glob pattern
+    # matched against them (all studies if None)
+    header = pd.read_csv(results_path, nrows=0).columns
+    suffix = f" {dimensions[0]} lacey"
+    all_studies = [col[:-len(suffix)] for col in header if col.endswith(suffix)]
+
+    if studies is None:
+        selected = all_studies
+    elif isinstance(studies, str):
+        selected = [name for name in all_studies if fnmatch.fnmatchcase(name, studies)]
+    else:
+        selected = [name for name in all_studies if name in set(studies)]
+
+    columns = ["time"] + [f"{name} {dim} lacey" for name in selected for dim in dimensions]
+    df = pd.read_csv(results_path, usecols=columns, dtype={col: np.float32 for col in columns[1:]})
+
+    if t_min is not None:
+        df = df[df["time"] >= t_min]
+
+    return df.reset_index(drop=True), selected
+
+
+def fitted_curves(df: pd.DataFrame,
+                  studies: list[str],
+                  dimension: str,
+                  k_df: pd.DataFrame | None = None) -> tuple[np.ndarray, np.ndarray]:
+    # The fitted k and plateau A of every study. k is read from the
+    # fitted_k_values.csv of lacey_fitting.py where available, and the remaining
+    # studies are fitted in one batch. A is the maximum of the data from t = 2
+    time = df["time"].values
+    fitted = time >= FIT_START
+    data = df[[f"{name} {dimension} lacey" for name in studies]].values.T.astype(float)
+
+    A = np.nanmax(np.where(fitted, data, np.nan), axis=1)
+    k = np.full(len(studies), np.nan)
+
+    # The study names written by lacey_fitting.py end in a space
+    if k_df is not None:
+        k_values = k_df.set_index(k_df["study name"].str.strip())[f"{dimension} lacey k"]
+        k = k_values.reindex(studies).values.astype(float)
+
+    # Studies with data at every time are fitted together, the rest one by one
+    missing = np.isnan(k) & np.isfinite(A)
+    complete = missing & ~np.isnan(data[:, fitted]).any(axis=1)
+    if complete.any():
+        k[complete] = fit_lacey_batch(data[complete][:, fitted], time[fitted], A[complete])
+
+    for i in np.flatnonzero(missing & ~complete):
+        valid = fitted & ~np.isnan(data[i])
+        if valid.sum() > 1:
+            k[i] = fit_lacey_batch(data[i, valid], time[valid], A[i])[0]
+
+    return k, A
+
+
+def decimate(time: np.ndarray, values: np.ndarray, max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    # Keeps at most `max_points` samples of each series (studies along axis 0),
+    # evenly spaced in time
+    if len(time) <= max_points:
+        return time, values
+
+    indices = np.unique(np.linspace(0, len(time) - 1, max_points).round().astype(int))
+    return time[indices], values[:, indices]
+
+
+def _segments(x: np.ndarray, y: np.ndarray) -> list[np.ndarray]:
+    # One (n, 2) line per row of y, without the NaN samples. x is shared by all
+    # rows or given per row
+    x = np.broadcast_to(x, y.shape)
+    return [np.column_stack([x_row, y_row])[~np.isnan(y_row)] for x_row, y_row in zip(x, y)]
+
+
+def plot_small_multiples(df: pd.DataFrame,
+                         studies: list[str],
+                         dimension: str,
+                         k_df: pd.DataFrame | None = None,
+                         ncols: int | None = None,
+                         max_points: int = 200,
+                         save_path: str = "lacey_small_multiples.png",
+                         dpi: int = 150) -> None:
+    # Draws every study in its own panel, with the data and fitted curve of one
+    # dimension. The panels are laid out on a single axes and all lines are drawn
+    # as two line collections, so hundreds of studies render in seconds
+    n = len(studies)
+    ncols = ncols or int(np.ceil(np.sqrt(n)))
+    nrows = int(np.ceil(n / ncols))
+
+    time, data = decimate(df["time"].values,
+                          df[[f"{name} {dimension} lacey" for name in studies]].values.T.astype(float), max_points)
+    k, A = fitted_curves(df, studies, dimension, k_df)
+    fit = np.where(time >= FIT_START, model(time[None, :], k[:, None], A[:, None]), np.nan)
+
+    # Map each panel to a unit cell with a margin, shared axis limits throughout
+    t_scale = 0.9 / (time[-1] - time[0])
+    y_low = np.nanmin([np.nanmin(data), 0])
+    y_scale = 0.75 / (max(np.nanmax(data), 1) - y_low)
+
+    cols = np.arange(n) % ncols
+    rows = np.arange(n) // ncols
+    x = cols[:, None] + 0.05 + (time[None, :] - time[0]) * t_scale
+    data_y = -rows[:, None] + 0.05 + (data - y_low) * y_scale
+    fit_y = -rows[:, None] + 0.05 + (fit - y_low) * y_scale
+
+    fig, ax = plt.subplots(figsize=[2 * ncols, 1.6 * nrows])
+
+    frames = [np.array([[c, -r], [c + 1, -r], [c + 1, 1 - r], [c, 1 - r], [c, -r]]) for c, r in zip(cols, rows)]
+    ax.add_collection(LineCollection(frames, colors="0.8", linewidths=0.5))
+    ax.add_collection(LineCollection(_segments(x, data_y), colors=COLOURS[dimension], linewidths=0.8))
+    ax.add_collection(LineCollection(_segments(x, fit_y), colors="0.3", linewidths=0.8, linestyles="--"))
+
+    for name, c, r, k_value in zip(studies, cols, rows, k):
+        ax.text(c + 0.05, 0.95 - r, f"{name}\nk={k_value:.3g}", fontsize=5, va="top")
+
+    ax.set_xlim(0, ncols)
+    ax.set_ylim(1 - nrows, 1)
+    ax.set_axis_off()
+    ax.set_title(f"{dimension} mixing index, t = {time[0]:g} to {time[-1]:g} s, "
+                 f"index {y_low:g} to {max(np.nanmax(data), 1):g} (dashed: fitted model)", fontsize=10)
+
+    fig.tight_layout()
+    fig.savefig(save_path, dpi=dpi)
+    plt.close(fig)
+    print(f"Saved {n} studies to '{save_path}'")
+
+
+def plot_overlay(df: pd.DataFrame,
+                 studies: list[str],
+                 dimension: str,
+                 k_df: pd.DataFrame | None = None,
+                 colour_by: str | None = None,
+                 show_fits: bool = False,
+                 max_points: int = 500,
+                 save_path: str = "lacey_overlay.png",
+                 dpi: int = 150) -> None:
+    # Draws every study on one axes, coloured by a parameter parsed from the
+    # study names (or by fitted k if `colour_by` is None)
+    time, data = decimate(df["time"].values,
+                          df[[f"{name} {dimension} lacey" for name in studies]].values.T.astype(float), max_points)
+    k, A = fitted_curves(df, studies, dimension, k_df)
+
+    if colour_by is None:
+        colour_values, colour_label = k, f"{dimension} lacey k"
+    else:
+        colour_values = np.array([parse_study_name(name)[colour_by] for name in studies])
+        colour_label = colour_by
+
+    fig, ax = plt.subplots(figsize=[12, 7])
+
+    lines = LineCollection(_segments(time, data), cmap="viridis", linewidths=1, alpha=0.7)
+    lines.set_array(colour_values)
+    ax.add_collection(lines)
+
+    if show_fits:
+        fit = np.where(time >= FIT_START, model(time[None, :], k[:, None], A[:, None]), np.nan)
+        fits = LineCollection(_segments(time, fit),
+                              colors="0.3", linewidths=0.5, linestyles="--", alpha=0.5)
+        ax.add_collection(fits)
+
+    fig.colorbar(lines, ax=ax, label=colour_label)
+    ax.autoscale()
+    ax.set_xlabel("Time (s)", fontsize=10)
+    ax.set_ylabel("Mixing Index", fontsize=10)
+    ax.set_title(f"{dimension} mixing index of {len(studies)} studies", fontsize=12)
+    ax.grid()
+
+    fig.tight_layout()
+    fig.savefig(save_path, dpi=dpi)
+    plt.close(fig)
+    print(f"Saved {len(studies)} studies to '{save_path}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot the Lacey mixing index of many studies")
+    parser.add_argument("--results", default="../lacey-files/lacey_results.csv", help="wide Lacey results CSV")
+    parser.add_argument("--k-values", default="fitted_k_values.csv",
+                        help="fitted k values from lacey_fitting.py, fitted here if not found")
+    parser.add_argument("--studies", default=None, help="glob pattern of the study names to plot")
+    parser.add_argument("--dimensions", nargs="+", default=DIMENSIONS, choices=DIMENSIONS)
+    parser.add_argument("--mode", choices=["small", "overlay"], default="small")
+    parser.add_argument("--colour-by", default=None, help="parameter to colour the overlay by (default fitted k)")
+    parser.add_argument("--t-min", type=float, default=None, help="leave out data before this time")
+    parser.add_argument("--max-points", type=int, default=200, help="samples kept per line")
+    parser.add_argument("--output-prefix", default="lacey")
+    args = parser.parse_args()
+
+    try:
+        k_df = pd.read_csv(args.k_values)
+    except FileNotFoundError:
+        print(f"No fitted k values found at '{args.k_values}', fitting the curves")
+        k_df = None
+
+    df, studies = read_results(args.results, args.studies, args.dimensions, args.t_min)
+    print(f"Read {len(studies)} studies and {len(df)} time steps from '{args.results}'")
+
+    for dimension in args.dimensions:
+        if args.mode == "small":
+            plot_small_multiples(df, studies, dimension, k_df, max_points=args.max_points,
+                                 save_path=f"{args.output_prefix}_{dimension}_small_multiples.png")
+        else:
+            plot_overlay(df, studies, dimension, k_df, args.colour_by, max_points=args.max_points,
+                         save_path=f"{args.output_prefix}_{dimension}_overlay.png")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import re
+import math
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator, RBFInterpolator
+
+
+# A parameter name followed by its value, in either the folder format created by
+# `Study.generate_studies` ("fricPp_0.5-amp_0.01") or the "fricPp: 0.5, amp: 0.01" format
+NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+STUDY_PARAMETER = re.compile(rf"([A-Za-z_]\w*?)(?:_|: )({NUMBER})(?:-|, |$)")
+
+# Largest number of points of the regular grid a scattered design is resampled onto
+MAX_GRID_POINTS = 100_000
+
+
+def parse_study_name(study_name: str) -> dict[str, float]:
+    study_name = study_name.strip()
+    matches = list(STUDY_PARAMETER.finditer(study_name))
+
+    if not matches or sum(len(m.group(0)) for m in matches) != len(study_name):
+        raise ValueError(f"Could not parse parameters from study name '{study_name}'")
+
+    return {m.group(1): float(m.group(2)) for m in matches}
+
+
+def build_k_grid(k_df: pd.DataFrame,
+                 k_column: str,
+                 max_points: int = MAX_GRID_POINTS) -> tuple[list[str], list[np.ndarray], np.ndarray]:
+    # Rebuild the N-dimensional parameter grid from the study names. A complete
+    # full factorial sweep is used as it is. Any other design (space-filling,
+    # refined, or a factorial sweep with failed studies or fits) would leave
+    # the grid mostly or partly empty, which biases the averages over it, so it
+    # is resampled onto a regular grid through a surrogate instead
+    k_df = k_df.dropna(subset=[k_column])
+    parameters = [parse_study_name(name) for name in k_df["study name"]]
+    param_names = list(parameters[0].keys())
+
+    # Repeated combinations are averaged
+    values, inverse = np.unique([[params[name] for name in param_names] for params in parameters],
+                                axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    k_values = np.bincount(inverse, k_df[k_column].values) / np.bincount(inverse)
+
+    axes = [np.unique(values[:, i]) for i in range(len(param_names))]
+
+    if len(values) < math.prod(len(axis) for axis in axes):
+        return param_names, *scattered_k_grid(values, k_values, axes, max_points)
+
+    indices = tuple(np.searchsorted(axis, values[:, i]) for i, axis in enumerate(axes))
+
+    grid = np.empty([len(axis) for axis in axes])
+    grid[indices] = k_values
+
+    return param_names, axes, grid
+
+
+def scattered_k_grid(values: np.ndarray,
+                     k_values: np.ndarray,
+                     axes: list[np.ndarray],
+                     max_points: int = MAX_GRID_POINTS) -> tuple[list[np.ndarray], np.ndarray]:
+    # Resample k at scattered parameter combinations onto a regular grid with a
+    # thin plate spline RBF surrogate, fitted on parameters scaled to [0, 1].
+    # Parameters with a single value keep it, the others keep their values if
+    # there are few enough, otherwise they are evenly spaced over their range
+    varied = [i for i, axis in enumerate(axes) if len(axis) > 1]
+
+    if len(values) < len(varied) + 2:
+        raise ValueError(f"At least {len(varied) + 2} studies are needed to fit a surrogate over "
+                         f"{len(varied)} parameters, found {len(values)}")
+
+    levels = max(2, int(max_points ** (1 / max(len(varied), 1))))
+    grid_axes = [axis if len(axis) <= levels else np.linspace(axis[0], axis[-1], levels) for axis in axes]
+
+    if not varied:
+        return grid_axes, np.full([1] * len(axes), np.mean(k_values))
+
+    lower = np.array([axes[i][0] for i in varied])
+    scale = np.array([axes[i][-1] - axes[i][0] for i in varied])
+
+    surrogate = RBFInterpolator((values[:, varied] - lower) / scale, k_values, kernel="thin_plate_spline")
+
+    mesh = np.meshgrid(*[grid_axes[i] for i in varied], indexing="ij")
+    points = (np.column_stack([m.ravel() for m in mesh]) - lower) / scale
+
+    # The parameters with a single value are length 1 dimensions of the grid
+    grid = surrogate(points).reshape([len(axis) for axis in grid_axes])
+
+    return grid_axes, grid
+
+
+def response_surface(axes: list[np.ndarray],
+                     grid: np.ndarray,
+                     surface_params: tuple[int, int],
+                     resolution: int = 50,
+                     fixed_values: dict[int, float] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Interpolate k over two parameters on a `resolution` x `resolution` mesh.
+    # The remaining parameters are held at `fixed_values` (by parameter index),
+    # or averaged over when no value is given
+    fixed_values = fixed_values or {}
+    i, j = surface_params
+
+    # Average over the dimensions that are neither plotted nor fixed
+    averaged = tuple(d for d in range(grid.ndim) if d not in (i, j) and d not in fixed_values)
+    reduced_grid = np.nanmean(grid, axis=averaged) if averaged else grid
+    reduced_dims = [d for d in range(grid.ndim) if d not in averaged]
+
+    interpolator = RegularGridInterpolator([axes[d] for d in reduced_dims], reduced_grid,
+                                           bounds_error=False, fill_value=np.nan)
+
+    x = np.linspace(axes[i][0], axes[i][-1], resolution)
+    y = np.linspace(axes[j][0], axes[j][-1], resolution)
+    X, Y = np.meshgrid(x, y, indexing="ij")
+
+    points = np.empty(X.shape + (len(reduced_dims),))
+    for n, d in enumerate(reduced_dims):
+        if d == i:
+            points[..., n] = X
+        elif d == j:
+            points[..., n] = Y
+        else:
+            points[..., n] = fixed_values[d]
+
+    return X, Y, interpolator(points)
+
+
+def anova_effects(grid: np.ndarray, max_order: int = 2) -> dict[tuple[int, ...], np.ndarray]:
+    # Functional ANOVA decomposition of a full factorial grid. Each effect is
+    # the mean over the other dimensions minus all lower order effects
+    # contained in it, broadcastable against `grid`
+    effects = {(): np.nanmean(grid, keepdims=True)}
+
+    for order in range(1, max_order + 1):
+        for dims in itertools.combinations(range(grid.ndim), order):
+            other_dims = tuple(d for d in range(grid.ndim) if d not in dims)
+            effect = np.nanmean(grid, axis=other_dims, keepdims=True) if other_dims else grid.copy()
+
+            for sub_order in range(order):
+                for sub_dims in itertools.combinations(dims, sub_order):
+                    effect = effect - effects[sub_dims]
+
+            effects[dims] = effect
+
+    return effects
+
+
+def sensitivity_indices(grid: np.ndarray, max_order: int = 2) -> dict[tuple[int, ...], float]:
+    # Sobol-style indices: the fraction of the variance of k over the grid
+    # explained by each main effect and interaction
+    effects = anova_effects(grid, max_order)
+    total_variance = np.nanvar(grid)
+
+    indices = {}
+    for dims, effect in effects.items():
+        if dims:
+            indices[dims] = np.nanmean(np.broadcast_to(effect, grid.shape)[~np.isnan(grid)] ** 2) / total_variance
+
+    return indices
+
+
+def build_sensitivity_df(k_df: pd.DataFrame, max_order: int = 2) -> pd.DataFrame:
+    dimensions = ["x", "y", "z", "r"]
+    rows = []
+
+    for dim in dimensions:
+        param_names, _, grid = build_k_grid(k_df, f"{dim} lacey k")
+        indices = sensitivity_indices(grid, max_order)
+
+        for dims, index in indices.items():
+            rows.append([f"{dim} lacey k", " x ".join(param_names[d] for d in dims), len(dims), index])
+
+    return pd.DataFrame(rows, columns=["k column", "effect", "order", "sensitivity index"])
+
+
+def main():
+    k_values_path = "fitted_k_values.csv"
+
+    k_df = pd.read_csv(k_values_path)
+    sensitivity_df = build_sensitivity_df(k_df)
+
+    for k_column, group in sensitivity_df.groupby("k column", sort=False):
+        print(f"{k_column} sensitivity:")
+        for _, row in group.sort_values("sensitivity index", ascending=False).iterrows():
+            print(f"    {row['effect']}: {row['sensitivity index']:.3f}")
+
+    sensitivity_df.to_csv("sensitivity_indices.csv", index=False)
+    print("Sensitivity indices saved to 'sensitivity_indices.csv'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import re
+import sys
+import glob
+import json
+import pandas as pd
+from natsort import natsorted
+
+from lacey_sensitivity import parse_study_name
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "study-setup"))
+import sweep_manifest
+
+
+base_dir = "../sweep_output"
+study_format = "num_particles: *, fric_pp: *, amp: *"
+
+# Offsets and partial results of every file read so far, so later runs only read
+# what was appended since
+STATE_NAME = "run_health_state.json"
+
+# Lines of the slurm-*.stats files and LIGGGHTS logs
+EXIT_CODE = re.compile(r"\|\s*Exitcode\s+(-?\d+):(\d+)")
+WALL_TIME = re.compile(r"\|\s*(?:Elapsed|Wall-?clock time|Job Wall-clock time|Walltime)\s*:?\s+([\d:.-]+)\s*(s)?\b",
+                       re.IGNORECASE)
+MAX_RSS = re.compile(r"\|\s*(?:MaxRSS|Max RSS|Memory Utilized)\s*:?\s+([\d.]+)\s*([KMGT]?)i?B?", re.IGNORECASE)
+LOOP_TIME = re.compile(r"Loop time of ([\d.eE+-]+) on (\d+) procs for (\d+) steps with (\d+) atoms")
+
+LOOP_KEYS = ("loop_time_s", "steps", "atom_steps", "atoms", "procs")
+
+# Columns of the run health table, after the study name and parameters
+COLUMNS = ["exit_code", "signal", "wall_time_s", "max_rss_mb", "dumps", "vtk_files", "procs", "atoms", "steps",
+           "loop_time_s", "atom_steps_per_s", "atom_steps_per_s_per_proc"]
+
+# Memory units in MB
+MEMORY_UNITS = {"": 1 / 2**20, "K": 1 / 2**10, "M": 1, "G": 2**10, "T": 2**20}
+
+
+def parse_duration(value: str, seconds: bool = False) -> float:
+    # "123.4" with a seconds unit, or SLURM's [D-]HH:MM:SS / MM:SS
+    if seconds or ":" not in value:
+        return float(value)
+
+    days, _, clock = value.rpartition("-")
+    total = 0.0
+    for part in clock.split(":"):
+        total = total * 60 + float(part)
+
+    return total + 86400 * int(days or 0)
+
+
+def parse_lines(lines: list[str], record: dict) -> dict:
+    # Updates the run health record of a file with the new lines read from it.
+    # Loop times accumulate over the runs of a LIGGGHTS script, the rest are
+    # overwritten by the latest value
+    for line in lines:
+        if (match := EXIT_CODE.search(line)):
+            record["exit_code"] = int(match.group(1))
+            record["signal"] = int(match.group(2))
+
+        elif (match := WALL_TIME.search(line)):
+            record["wall_time_s"] = parse_duration(match.group(1), match.group(2) == "s")
+
+        elif (match := MAX_RSS.search(line)):
+            record["max_rss_mb"] = float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()]
+
+        elif (match := LOOP_TIME.search(line)):
+            loop_time, procs, steps, atoms = (float(match.group(1)), int(match.group(2)),
+                                              int(match.group(3)), int(match.group(4)))
+            record["loop_time_s"] = record.get("loop_time_s", 0.0) + loop_time
+            record["steps"] = record.get("steps", 0) + steps
+            record["atom_steps"] = record.get("atom_steps", 0) + atoms * steps
+            record["atoms"] = atoms
+            record["procs"] = procs
+
+    return record
+
+
+def read_new_lines(path: str, file_state: dict) -> list[str] | None:
+    # Reads the complete lines appended to a file since the offset in its state,
+    # or the whole file again if it was replaced or truncated. Returns None if the
+    # file has not changed
+    stat = os.stat(path)
+    if file_state.get("mtime") == stat.st_mtime and file_state.get("size") == stat.st_size:
+        return None
+
+    if stat.st_size < file_state.get("offset", 0) or stat.st_mtime < file_state.get("mtime", 0):
+        file_state.clear()
+
+    with open(path, "rb") as f:
+        f.seek(file_state.get("offset", 0))
+        data = f.read()
+
+    # A partially written last line is left for the next run
+    end = data.rfind(b"\n") + 1
+    file_state["offset"] = file_state.get("offset", 0) + end
+    file_state["mtime"] = stat.st_mtime
+    file_state["size"] = stat.st_size if end == len(data) else -1
+
+    return data[:end].decode(errors="replace").splitlines()
+
+
+def count_dumps(post_dir: str, dir_state: dict) -> dict:
+    # The numbers of particle and mesh dumps, only counted again when files have
+    # been added to or removed from the post directory
+    mtime = os.stat(post_dir).st_mtime
+    if dir_state.get("mtime") != mtime:
+        names = os.listdir(post_dir)
+        dir_state.update(mtime=mtime,
+                         dumps=sum(name.startswith("particles_") and name.endswith(".vtk") for name in names),
+                         vtk_files=sum(name.endswith(".vtk") for name in names))
+
+    return dir_state
+
+
+def index_study(folder: str, study_state: dict) -> dict:
+    # Run health of a study from its slurm-*.stats and slurm-*.out files and
+    # LIGGGHTS log, reading only what changed since the last run
+    files = study_state.setdefault("files", {})
+    paths = (glob.glob(os.path.join(folder, "slurm-*.stats")) + glob.glob(os.path.join(folder, "slurm-*.out"))
+             + glob.glob(os.path.join(folder, "log.liggghts")))
+
+    for path in natsorted(paths):
+        file_state = files.setdefault(os.path.basename(path), {})
+
+        # The state, and with it the record, is reset if the file is read from the
+        # beginning again
+        lines = read_new_lines(path, file_state)
+        if lines is not None:
+            file_state["record"] = parse_lines(lines, file_state.get("record", {}))
+
+    # The LIGGGHTS log and the job output usually hold the same loop times, so
+    # the log is preferred and the output only used when there is no log
+    records = [state["record"] for name, state in natsorted(files.items()) if "record" in state]
+    log_record = files.get("log.liggghts", {}).get("record")
+
+    study = {}
+    for record in records:
+        if record is log_record:
+            continue
+        study.update({key: value for key, value in record.items() if not (log_record and key in LOOP_KEYS)})
+    if log_record:
+        study.update(log_record)
+
+    post_dir = os.path.join(folder, "post")
+    if os.path.isdir(post_dir):
+        dumps = count_dumps(post_dir, study_state.setdefault("post", {}))
+        study["dumps"] = dumps["dumps"]
+        study["vtk_files"] = dumps["vtk_files"]
+
+    if study.get("loop_time_s"):
+        study["atom_steps_per_s"] = study["atom_steps"] / study["loop_time_s"]
+        study["atom_steps_per_s_per_proc"] = study["atom_steps_per_s"] / study["procs"]
+
+    return study
+
+
+def build_run_health(sweep_dir: str, study_folders: list[str], update_manifest: bool = True) -> pd.DataFrame:
+    # Consolidated run health table of a sweep, one row per study, with the
+    # parameter values of each study. The state file in the sweep directory
+    # is updated so the next run only reads new output
+    state_path = os.path.join(sweep_dir, STATE_NAME)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+
+    rows = []
+    manifest_updates = {}
+    for folder in natsorted(study_folders):
+        if not os.path.isdir(folder):
+            continue
+
+        study_name = os.path.basename(folder)
+        study = index_study(folder, state.setdefault(study_name, {}))
+
+        try:
+            parameters = parse_study_name(study_name)
+        except ValueError:
+            parameters = {}
+
+        rows.append({"study": study_name, **parameters, **{column: study.get(column) for column in COLUMNS}})
+
+        if study.get("exit_code") is not None:
+            manifest_updates[study_name] = {"exit_code": study["exit_code"],
+                                            "status": "finished" if study["exit_code"] == 0 else "failed"}
+        if study.get("dumps") is not None:
+            manifest_updates.setdefault(study_name, {})["dumps"] = study["dumps"]
+
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_path, state_path)
+
+    if update_manifest and manifest_updates and sweep_manifest.load_manifest(sweep_dir) is not None:
+        sweep_manifest.update_studies(sweep_dir, manifest_updates)
+
+    return pd.DataFrame(rows)
+
+
+def main():
+    output_path = "run_health.csv"
+
+    # Studies are read from the sweep manifest, or found by globbing if there is none
+    study_folders = sweep_manifest.list_studies(base_dir)
+    if study_folders is None:
+        study_folders = glob.glob(os.path.join(base_dir, study_format))
+
+    health_df = build_run_health(base_dir, study_folders)
+    if health_df.empty:
+        print("No studies found")
+        return
+
+    health_df.to_csv(output_path, index=False)
+    print(f"Run health of {len(health_df)} studies saved to '{output_path}'")
+
+    failed = health_df[health_df["exit_code"].notna() & (health_df["exit_code"] != 0)]
+    print(f"{len(failed)} studies with non-zero exit codes, {health_df['exit_code'].isna().sum()} without an exit code")
+
+    if health_df["atom_steps_per_s"].notna().any():
+        print(f"Median throughput {health_df['atom_steps_per_s'].median():.3g} atom-steps/s, "
+              f"{health_df['atom_steps_per_s_per_proc'].median():.3g} per process")
+
+
+if __name__ == "__main__":
+    main()
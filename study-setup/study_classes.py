@@ -3,10 +3,21 @@ import warnings
 import numpy as np
 import os
 import itertools
+import re
 import shutil
+import subprocess
+import time
+import csv
+import traceback
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.stats import qmc
 from jinja2 import Environment, FileSystemLoader, Template
 from natsort import natsorted
 import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import sweep_manifest
 
 
 class Parameter:
@@ -17,12 +28,37 @@ class Parameter:
         name (str): This name should be the same as the parameter's placeholder name in within the template files. 
         filename (str): This is the name of the template file that this parameter appears in.
         values: (List[float]): The values this parameter can take withiin the parameter space.
+        bounds (Tuple[float, float]): The lower and upper value of the parameter. Given instead of `values` for a
+            continuous parameter, which can only be sampled by `Study.generate_design`.
     """
-    def __init__(self, name: str, filename: str, values: list[float]):
+    def __init__(self, name: str, filename: str, values: list[float] | None = None,
+                 bounds: tuple[float, float] | None = None):
+        if (values is None) == (bounds is None):
+            raise ValueError(f"Parameter {name} needs either a list of values or continuous bounds")
+
         self.name = name
         self.filename = filename
         self.values = values
-        self.samples = len(values)
+        self.continuous = values is None
+
+        if self.continuous:
+            self.samples = None
+            self.bounds = (float(bounds[0]), float(bounds[1]))
+        else:
+            self.samples = len(values)
+            self.bounds = (float(np.min(values)), float(np.max(values)))
+
+
+    def from_unit(self, u: np.ndarray) -> np.ndarray:
+        """
+        Maps samples in [0, 1] onto the parameter. Continuous parameters are scaled onto their bounds and discrete
+        parameters take the value of the equally sized stratum each sample falls in.
+        """
+        if self.continuous:
+            return self.bounds[0] + u * (self.bounds[1] - self.bounds[0])
+
+        indices = np.minimum((u * self.samples).astype(int), self.samples - 1)
+        return np.asarray(self.values)[indices]
 
 
 class Study:
@@ -81,74 +117,334 @@ class Study:
         Returns:
             np.ndarray: An array where each row represents a unique combination of parameter values within the parameter space.
         """
+        self._check_discrete("generate_phase_space")
+
         parameter_values = [param.values for param in self.parameters]
         phase_space_combinations = list(itertools.product(*parameter_values))
         
         return np.array(phase_space_combinations)
-    
+
+
+    def generate_coarse_space(self, levels: int = 2) -> np.ndarray:
+        """
+        Generates a coarse grid using `levels` evenly spread values of each parameter, always including its first and last value.
+
+        Args:
+            levels (int): The number of values taken from each parameter.
+
+        Returns:
+            np.ndarray: An array where each row represents a unique combination of parameter values within the coarse grid.
+        """
+        self._check_discrete("generate_coarse_space")
+
+        parameter_values = []
+        for param in self.parameters:
+            indices = np.unique(np.round(np.linspace(0, param.samples - 1, min(levels, param.samples))).astype(int))
+            parameter_values.append([param.values[i] for i in indices])
+
+        return np.array(list(itertools.product(*parameter_values)))
+
+
+    def generate_latin_hypercube(self, n_samples: int, seed: int | None = None) -> np.ndarray:
+        """
+        Generates a Latin hypercube sample of the parameter space. Equivalent to `generate_design("lhs", n_samples, seed)`.
+        """
+        return self.generate_design("lhs", n_samples, seed)
+
+
+    def generate_design(self, method: str, n_samples: int, seed: int | None = None) -> np.ndarray:
+        """
+        Generates a sparse sample of the parameter space with a target number of combinations.
+
+        Samples are drawn in the unit hypercube and mapped onto each parameter with `Parameter.from_unit`, so continuous
+        parameters are sampled anywhere within their bounds and discrete parameters are snapped to their values. Duplicate
+        combinations created by snapping are removed, so fewer than `n_samples` rows may be returned.
+
+        Args:
+            method (str): One of "lhs" (Latin hypercube), "sobol", "halton" or "fractional" (two level fractional
+                factorial using the lowest and highest value of each parameter).
+            n_samples (int): The target number of parameter combinations. Sobol samples are best balanced when this is a
+                power of 2. The fractional factorial uses the smallest power of 2 that is at least `n_samples` and large
+                enough to estimate every main effect.
+            seed (int, optional): Seed used to randomise the sequences.
+
+        Returns:
+            np.ndarray: An array where each row represents a unique combination of parameter values.
+        """
+        n_params = len(self.parameters)
+
+        if method == "lhs":
+            unit_samples = qmc.LatinHypercube(d=n_params, seed=seed).random(n_samples)
+
+        elif method == "sobol":
+            unit_samples = qmc.Sobol(d=n_params, seed=seed).random(n_samples)
+
+        elif method == "halton":
+            unit_samples = qmc.Halton(d=n_params, seed=seed).random(n_samples)
+
+        elif method == "fractional":
+            unit_samples = self._fractional_factorial(n_params, n_samples)
+
+        else:
+            raise ValueError(f"{method} is not a recognised design method")
+
+        columns = [param.from_unit(unit_samples[:, i]) for i, param in enumerate(self.parameters)]
+
+        return np.unique(np.column_stack(columns), axis=0)
+
+
+    @staticmethod
+    def _fractional_factorial(n_params: int, n_samples: int) -> np.ndarray:
+        """
+        Builds a two level fractional factorial design in {0, 1}. A full factorial is taken over as many base factors as
+        the run count allows, and the remaining factors are aliased with the highest order interactions of the base factors.
+        """
+        n_base = max(1, int(np.ceil(np.log2(max(n_samples, n_params + 1)))))
+        n_base = min(n_base, n_params)
+
+        base = np.array(list(itertools.product([-1, 1], repeat=n_base)))
+
+        generators = []
+        for order in range(n_base, 1, -1):
+            generators.extend(itertools.combinations(range(n_base), order))
+
+        columns = [base[:, i] for i in range(n_base)]
+        for generator in generators[:n_params - n_base]:
+            columns.append(np.prod(base[:, list(generator)], axis=1))
+
+        return (np.column_stack(columns) + 1) / 2
+
+
+    def _check_discrete(self, method_name: str) -> None:
+        """
+        Raises an error if a method that needs discrete parameter values is used with continuous parameters.
+        """
+        continuous = [param.name for param in self.parameters if param.continuous]
+        if continuous:
+            raise ValueError(f"{method_name} needs discrete parameter values, but {continuous} are continuous. "
+                             "Use generate_design instead.")
+
+
+    def refine_phase_space(self, k_values_file: str, n_new: int, k_column: str = "r lacey k",
+                           output_dir: str | None = None, exploration: float = 0.1,
+                           n_candidates: int = 4096) -> np.ndarray:
+        """
+        Proposes new parameter combinations from the full parameter space where the fitted mixing rates are most uncertain
+        or change most steeply.
+
+        Each unevaluated combination is scored by its distance to the nearest evaluated study (uncertainty) multiplied by the
+        spread of k across its nearest evaluated neighbours (steepness). Combinations are picked greedily, with each pick
+        counting as evaluated for the distance of later picks so that the proposals do not cluster.
+
+        Args:
+            k_values_file (str): The `fitted_k_values.csv` file created by `lacey_fitting.py`.
+            n_new (int): The number of new combinations to propose.
+            k_column (str): The fitted k column the refinement is based on.
+            output_dir (str, optional): If given, combinations that already have a study folder here are not proposed.
+            exploration (float): Weight given to distance alone, so unexplored regions of a flat response are still sampled.
+            n_candidates (int): If any parameter is continuous, the candidates are a Sobol sample of this size instead of
+                the full parameter space.
+
+        Returns:
+            np.ndarray: An array where each row represents a proposed combination of parameter values.
+        """
+        k_df = pd.read_csv(k_values_file).dropna(subset=[k_column])
+        evaluated = np.array([self.parse_study_name(name) for name in k_df["study name"]])
+        k_values = k_df[k_column].values
+
+        if len(evaluated) < 2:
+            raise ValueError(f"At least 2 evaluated studies are needed to refine, found {len(evaluated)}")
+
+        if any(param.continuous for param in self.parameters):
+            candidates = self.generate_design("sobol", n_candidates)
+        else:
+            candidates = self.generate_phase_space()
+
+        # The study names written by lacey_fitting.py end in a space
+        excluded = {name.strip() for name in k_df["study name"]}
+        if output_dir is not None and os.path.isdir(output_dir):
+            excluded.update(os.listdir(output_dir))
+
+        is_new = np.array([self.get_study_name(combination) not in excluded for combination in candidates])
+        candidates = candidates[is_new]
+
+        if len(candidates) == 0:
+            return candidates
+
+        # Normalise each parameter to [0, 1] so distances are comparable between parameters
+        lower = np.array([param.bounds[0] for param in self.parameters])
+        scale = np.array([param.bounds[1] - param.bounds[0] for param in self.parameters])
+        scale[scale == 0] = 1
+
+        evaluated_points = (evaluated - lower) / scale
+        candidate_points = (candidates - lower) / scale
+
+        n_neighbours = min(len(evaluated), len(self.parameters) + 1)
+        distances, neighbours = cKDTree(evaluated_points).query(candidate_points, k=n_neighbours)
+
+        k_spread = np.ptp(k_values[neighbours], axis=1)
+        k_range = np.ptp(k_values)
+        steepness = k_spread / k_range if k_range > 0 else np.zeros(len(candidates))
+
+        nearest_distance = distances[:, 0]
+
+        selected = []
+        for _ in range(min(n_new, len(candidates))):
+            score = nearest_distance * (steepness + exploration)
+            score[selected] = -np.inf
+
+            best = int(np.argmax(score))
+            selected.append(best)
+
+            new_distance = np.linalg.norm(candidate_points - candidate_points[best], axis=1)
+            nearest_distance = np.minimum(nearest_distance, new_distance)
+
+        return candidates[selected]
+
 
     def get_param_names(self) -> list[str]:
         """
         Returns a list of the names of all parameters being studied.
         """
         return [param.name for param in self.parameters]
+
+
+    def get_study_name(self, combination) -> str:
+        """
+        Returns the study folder name of a combination of parameter values.
+        """
+        return "-".join([f"{name}_{value}" for name, value in zip(self.get_param_names(), combination)])
+
+
+    def parse_study_name(self, study_name: str) -> list[float]:
+        """
+        Returns the parameter values encoded in a study folder name created by `get_study_name`.
+        """
+        pattern = "-".join([f"{re.escape(name)}_(.+?)" for name in self.get_param_names()])
+        match = re.fullmatch(pattern, os.path.basename(study_name.strip()))
+
+        if match is None:
+            raise ValueError(f"'{study_name}' does not match the study format {self.get_study_format()}")
+
+        return [float(value) for value in match.groups()]
         
 
-    def generate_studies(self, output_dir: str) -> None:
+    def generate_studies(self, output_dir: str, combinations: np.ndarray | None = None,
+                         static_mode: str = "hardlink", max_workers: int | None = None) -> None:
         """
         Generates a study directory for each combination of parameters . Within each directory, all files within `study-templates` are copied in.
             - Files named in `self.dyanmic_files` will have their templates rendered with a unique parameter combination when copied in.
             - Files named in the `static_files` local variable will be copied in as they are with no modification.
 
+        The templates are compiled once and the study directories are written concurrently by a thread pool.
+
         Args:
             output_dir (str): The directory where all generated studies will be saved.
+            combinations (np.ndarray, optional): The parameter combinations to generate studies for, such as those proposed
+                by `refine_phase_space`. Defaults to the full parameter space from `generate_phase_space`.
+            static_mode (str): How static files are placed in each study: "hardlink" (default), "copy" or "symlink".
+                Linked files share their contents with the template, so they must not be edited inside a study; use
+                "copy" if they are. Hardlinks fall back to copies if the output directory is on a different filesystem
+                to the templates.
+            max_workers (int, optional): The number of threads writing study directories. Defaults to the
+                `ThreadPoolExecutor` default.
         """
-        param_combinations = self.generate_phase_space()
-        param_names = self.get_param_names()
+        if static_mode not in ("copy", "hardlink", "symlink"):
+            raise ValueError(f"{static_mode} is not a recognised static file mode")
 
-        iteration = 0
-        for combination in param_combinations:
-            study_name = "-".join([f"{name}_{value}" for name, value in zip(param_names, combination)])
+        if combinations is None:
+            param_combinations = self.generate_phase_space()
+        else:
+            param_combinations = combinations
 
-            study_path = os.path.join(output_dir, study_name)
+        templates = self.get_jinja_templates(self.templates_location)
 
-            os.makedirs(study_path, exist_ok=True)
+        all_files = os.listdir(self.templates_location)
+        static_files = [file for file in all_files if file not in self.dynamic_files]
 
-            for template, params_in_template in self.get_jinja_templates(self.templates_location):
-                param_dict = {name: value for name, value in zip(param_names, combination)}
-                filtered_params = {name: param_dict[name] for name in params_in_template}
+        # Check for bash script to run workflow 
+        if "run.sh" not in all_files:
+            warnings.warn(f"No `run.sh` file found in {self.templates_location}. It is possible the run file has a different name, or is not present.")
 
-                rendered_content = template.render(**filtered_params)
+        # Check that geometry was present in template files
+        for file in all_files:
+            if file.endswith(".stl"):
+                break
+        else:
+            warnings.warn(f"No `.stl` file found in {self.templates_location}. It is possible the stl file has a different name, or is not present.") 
 
-                template_filename = os.path.basename(template.name) 
-                output_file_path = os.path.join(study_path, template_filename)
+        def write_study(combination):
+            study_path = os.path.join(output_dir, self.get_study_name(combination))
+            self._write_study(study_path, combination, templates, static_files, static_mode)
 
-                with open(output_file_path, "w") as sim_file:
-                    sim_file.write(rendered_content)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume the results so that errors in any thread are raised here
+            iteration = len(list(executor.map(write_study, param_combinations)))
 
-            all_files = os.listdir(self.templates_location)
-            static_files = [file for file in all_files if file not in self.dynamic_files]
+        # Record the parameters of each study so other tools do not have to rediscover them
+        param_names = self.get_param_names()
+        studies = {
+            self.get_study_name(combination): {name: float(value) for name, value in zip(param_names, combination)}
+            for combination in param_combinations
+        }
+
+        # A manifest created for a sweep generated without one also lists its earlier study folders, which would
+        # otherwise no longer be found
+        if sweep_manifest.load_manifest(output_dir) is None:
+            for folder in glob.glob(os.path.join(output_dir, self.get_study_format())):
+                study_name = os.path.basename(folder)
+                if study_name in studies or not os.path.isdir(folder):
+                    continue
+                try:
+                    studies[study_name] = dict(zip(param_names, self.parse_study_name(study_name)))
+                except ValueError:
+                    continue
+
+        sweep_manifest.register_studies(output_dir, param_names, studies)
 
-            # Check for bash script to run workflow 
-            if "run.sh" not in all_files:
-                warnings.warn(f"No `run.sh` file found in {self.templates_location}. It is possible the run file has a different name, or is not present.")
+        print(f"Created {iteration} studies in {output_dir}")  
 
-            # Check that geometry was present in template files
-            for file in all_files:
-                if file.endswith(".stl"):
-                    break
-            else:
-                warnings.warn(f"No `.stl` file found in {self.templates_location}. It is possible the stl file has a different name, or is not present.") 
-            
-            for file in static_files:
-                source_path = os.path.join(self.templates_location, file)
-                destination_path = os.path.join(study_path, file)
 
+    def _write_study(self, study_path: str, combination, templates: list[tuple[Template, list[str]]],
+                     static_files: list[str], static_mode: str) -> None:
+        """
+        Writes a single study directory, rendering each template with the parameter combination and placing each static file.
+        """
+        os.makedirs(study_path, exist_ok=True)
+
+        param_dict = {name: value for name, value in zip(self.get_param_names(), combination)}
+
+        for template, params_in_template in templates:
+            filtered_params = {name: param_dict[name] for name in params_in_template}
+
+            rendered_content = template.render(**filtered_params)
+
+            template_filename = os.path.basename(template.name) 
+            output_file_path = os.path.join(study_path, template_filename)
+
+            with open(output_file_path, "w") as sim_file:
+                sim_file.write(rendered_content)
+
+        for file in static_files:
+            source_path = os.path.join(self.templates_location, file)
+            destination_path = os.path.join(study_path, file)
+
+            if static_mode == "copy":
                 shutil.copy(source_path, destination_path)
+                continue
 
-            iteration += 1
+            # Links cannot overwrite files from a previous generation of the study
+            if os.path.lexists(destination_path):
+                os.remove(destination_path)
 
-        print(f"Created {iteration} studies in {output_dir}")  
+            if static_mode == "symlink":
+                os.symlink(os.path.abspath(source_path), destination_path)
+            else:
+                try:
+                    os.link(source_path, destination_path)
+                except OSError:
+                    warnings.warn(f"Could not hardlink static files from {self.templates_location}, copying them instead")
+                    shutil.copy(source_path, destination_path)
 
     
     def slurm_launch(self, output_dir):
@@ -161,9 +457,7 @@ class Study:
         Returns:
             None
         """
-        study_format = self.get_study_format()
-
-        run_folders = natsorted(glob.glob(os.path.join(output_dir, study_format))) 
+        run_folders = self.get_run_folders(output_dir)
         for index, run_folder in enumerate(run_folders):
             launch_file = os.path.join(run_folder, "run.sh")
             cmd = f"sbatch --output={run_folder}/slurm-%j.out {launch_file} {run_folder}"
@@ -174,6 +468,210 @@ class Study:
 
             os.system(cmd)  # Submit job
 
+        sweep_manifest.update_studies(output_dir, {
+            os.path.basename(run_folder): {"status": "submitted"} for run_folder in run_folders
+        })
+
+
+    def slurm_array_launch(self, output_dir: str, studies_per_task: int = 1, max_concurrent: int | None = None,
+                           max_array_size: int = 1000, sbatch: str = "sbatch") -> list[str]:
+        """
+        Submits all study directories in the output directory as SLURM job arrays instead of one job per study.
+
+        A manifest (`slurm_array_manifest.txt`) is written to the output directory with one line per array task, listing the
+        study folders that task runs. A wrapper script (`slurm_array.sh`) reads its task's line and runs each study's
+        `run.sh` in turn, writing the output of each study to `slurm-<array job id>_<task id>.out` within its folder. The
+        `#SBATCH` directives of the first study's `run.sh` are copied into the wrapper, except for the output, error and
+        array options. When several studies are packed into one task, the time limit in `run.sh` must cover all of them.
+
+        Args:
+            output_dir (str): The directory containing study folders.
+            studies_per_task (int): The number of studies packed into each array task.
+            max_concurrent (int, optional): The maximum number of array tasks running at once (the `%N` throttle).
+            max_array_size (int): The maximum number of tasks in one array (the site's MaxArraySize). Larger sweeps are
+                submitted as several arrays over consecutive parts of the manifest.
+            sbatch (str): The sbatch command, which can be replaced by a local stand-in script for testing.
+
+        Returns:
+            List[str]: The job IDs of the submitted arrays.
+        """
+        run_folders = [os.path.abspath(folder) for folder in self.get_run_folders(output_dir)]
+
+        if not run_folders:
+            print(f"No studies found in {output_dir}")
+            return []
+
+        tasks = [run_folders[i:i + studies_per_task] for i in range(0, len(run_folders), studies_per_task)]
+
+        manifest_file = os.path.abspath(os.path.join(output_dir, "slurm_array_manifest.txt"))
+        with open(manifest_file, "w") as manifest:
+            for task in tasks:
+                manifest.write("\t".join(task) + "\n")
+
+        # Keep the resource requests of the study run file
+        directives = []
+        with open(os.path.join(run_folders[0], "run.sh")) as run_file:
+            for line in run_file:
+                option = line.split()[1] if len(line.split()) > 1 else ""
+                if line.startswith("#SBATCH") and not option.startswith(("--output", "-o", "--error", "-e", "--array", "-a")):
+                    directives.append(line.rstrip("\n"))
+
+        wrapper_file = os.path.abspath(os.path.join(output_dir, "slurm_array.sh"))
+        with open(wrapper_file, "w") as wrapper:
+            wrapper.write("\n".join([
+                "#!/bin/bash",
+                *directives,
+                "",
+                "# Runs the studies on line (offset + task id + 1) of the manifest given as the first argument",
+                "manifest=\"$1\"",
+                "offset=\"${2:-0}\"",
+                "line=$(sed -n \"$((offset + SLURM_ARRAY_TASK_ID + 1))p\" \"$manifest\")",
+                "IFS=$'\\t' read -r -a folders <<< \"$line\"",
+                "",
+                "status=0",
+                "for folder in \"${folders[@]}\"; do",
+                "    bash \"$folder/run.sh\" \"$folder\" > \"$folder/slurm-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.out\" 2>&1 || status=$?",
+                "done",
+                "exit $status",
+                "",
+            ]))
+        os.chmod(wrapper_file, 0o755)
+
+        job_ids = []
+        for offset in range(0, len(tasks), max_array_size):
+            n_tasks = min(max_array_size, len(tasks) - offset)
+
+            array = f"0-{n_tasks - 1}"
+            if max_concurrent is not None:
+                array += f"%{max_concurrent}"
+
+            cmd = [sbatch, "--parsable", f"--array={array}",
+                   f"--output={os.path.abspath(output_dir)}/slurm-array-%A_%a.out",
+                   wrapper_file, manifest_file, str(offset)]
+
+            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+            job_id = result.stdout.strip().split(";")[0]
+            job_ids.append(job_id)
+
+            sweep_manifest.update_studies(output_dir, {
+                os.path.basename(folder): {"status": "submitted", "job_id": f"{job_id}_{task_id}"}
+                for task_id, task in enumerate(tasks[offset:offset + n_tasks]) for folder in task
+            })
+
+            print(f"Submitted array job {job_id} for studies {offset * studies_per_task + 1}-"
+                  f"{min((offset + n_tasks) * studies_per_task, len(run_folders))} of {len(run_folders)}")
+
+        return job_ids
+
+
+    def local_launch(self, output_dir: str, max_parallel: int | None = None, mpi_ranks: int = 1,
+                     command: str | None = None, exit_codes_file: str | None = None,
+                     on_complete=None) -> dict[str, int]:
+        """
+        Runs each study directory in the output directory on the local machine, as an alternative to `slurm_launch`.
+
+        Each study's `run.sh` is run as `bash <folder>/run.sh <folder>`, as it would be by `slurm_launch`, with the number
+        of MPI ranks exported as `MPI_RANKS` and `SLURM_NTASKS`. The output of each study is written to `slurm-local.out`
+        and its exit code to `slurm-local.stats` (in the `| Exitcode <code>:<signal>` format read by `exitcodes.py`).
+
+        Args:
+            output_dir (str): The directory containing study folders.
+            max_parallel (int, optional): The number of simulations run at once. Defaults to the number of CPUs divided by
+                `mpi_ranks`.
+            mpi_ranks (int): The number of MPI ranks used by each simulation.
+            command (str, optional): A shell command run inside each study folder instead of `run.sh`, where `{folder}`
+                and `{ranks}` are replaced by the study folder and `mpi_ranks`, e.g. "mpirun -np {ranks} liggghts -in resodyn.sim".
+            exit_codes_file (str, optional): If given, studies with non-zero exit codes are written to this CSV in the
+                same format as `exitcodes.py` (`study_name`, `exit_code`).
+            on_complete (callable, optional): Called as `on_complete(folder, exit_code)` as soon as each study finishes,
+                e.g. to calculate its Lacey mixing indices while the other studies are still running. It is called from
+                the launcher's threads, so any process pool it starts must spawn rather than fork its workers, as
+                `calculate_lacey.process_study` does. Spawned workers import the calling script, so its launching code
+                must be under `if __name__ == "__main__":`, as in `study_setup.py`, or every worker relaunches the
+                sweep. Errors raised by `on_complete` are reported and do not stop the other studies.
+
+        Returns:
+            Dict[str, int]: The exit code of each study folder.
+        """
+        run_folders = self.get_run_folders(output_dir)
+
+        if max_parallel is None:
+            max_parallel = max(1, (os.cpu_count() or 1) // mpi_ranks)
+
+        env = dict(os.environ, MPI_RANKS=str(mpi_ranks), SLURM_NTASKS=str(mpi_ranks), OMP_NUM_THREADS="1")
+
+        def run_study(run_folder):
+            sweep_manifest.update_study(output_dir, os.path.basename(run_folder), status="running")
+
+            if command is None:
+                args = dict(args=["bash", os.path.join(run_folder, "run.sh"), run_folder])
+            else:
+                args = dict(args=command.format(folder=run_folder, ranks=mpi_ranks), shell=True, cwd=run_folder)
+
+            start = time.perf_counter()
+            with open(os.path.join(run_folder, "slurm-local.out"), "w") as out_file:
+                returncode = subprocess.run(**args, env=env, stdout=out_file, stderr=subprocess.STDOUT).returncode
+            elapsed = time.perf_counter() - start
+
+            # Processes killed by a signal are reported like a shell would (128 + signal)
+            exit_code, signal = (returncode, 0) if returncode >= 0 else (128 - returncode, -returncode)
+
+            with open(os.path.join(run_folder, "slurm-local.stats"), "w") as stats_file:
+                stats_file.write(f"| Exitcode {exit_code}:{signal}\n")
+                stats_file.write(f"| Elapsed {elapsed:.1f} s\n")
+                stats_file.write(f"| MPI ranks {mpi_ranks}\n")
+
+            print(f"Finished {os.path.basename(run_folder)} with exit code {exit_code} in {elapsed:.1f} s")
+
+            sweep_manifest.update_study(output_dir, os.path.basename(run_folder), exit_code=exit_code,
+                                        status="finished" if exit_code == 0 else "failed",
+                                        dumps=len(glob.glob(os.path.join(run_folder, "post", "particles_*.vtk"))))
+
+            # A failed callback is reported without losing the exit code of the study
+            if on_complete is not None:
+                try:
+                    on_complete(run_folder, exit_code)
+                except Exception:
+                    print(f"on_complete failed for {os.path.basename(run_folder)}:\n{traceback.format_exc()}")
+
+            return exit_code
+
+        print(f"Running {len(run_folders)} studies, {max_parallel} at a time with {mpi_ranks} MPI ranks each")
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            exit_codes = dict(zip(run_folders, executor.map(run_study, run_folders)))
+
+        if exit_codes_file is not None:
+            non_zero_exit_codes = [(os.path.basename(folder), code) for folder, code in exit_codes.items() if code != 0]
+
+            with open(exit_codes_file, "w", newline="") as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(["study_name", "exit_code"])
+                writer.writerows(non_zero_exit_codes)
+
+            print(f"{len(non_zero_exit_codes)} studies with non-zero exit codes have been written to '{exit_codes_file}'.")
+
+        return exit_codes
+
+
+    def get_run_folders(self, output_dir: str) -> list[str]:
+        """
+        Lists the study directories in the output directory from the sweep manifest written by `generate_studies`, or by
+        matching the study format if the sweep has no manifest.
+
+        Args:
+            output_dir (str): The directory containing study folders.
+
+        Returns:
+            List[str]: The naturally sorted paths of the study folders.
+        """
+        run_folders = sweep_manifest.list_studies(output_dir)
+
+        if run_folders is None:
+            run_folders = natsorted(glob.glob(os.path.join(output_dir, self.get_study_format())))
+
+        return [folder for folder in run_folders if os.path.isdir(folder)]
+
 
     def get_study_format(self):
         """
@@ -2,7 +2,7 @@ from study_classes import Parameter, Study
 import os
 import numpy as np
 
-# Define paths 
+# Define paths
 templates_dir = "./study-templates"
 output_dir = "./sweep-output"
 
@@ -18,11 +18,47 @@ n_particles = Parameter("numParticles", "resodyn.sim", particle_values)
 friction = Parameter("fricPp", "particles.sim", friction_values)
 amplitude = Parameter("amp", "resodyn.sim", amplitude_values)
 
-# Create Study object and generate study directories
+# Create Study object
 my_study = Study([n_particles, friction, amplitude], templates_dir)
-my_study.generate_studies(output_dir)
 
-# Submit simulations as SLURM jobs 
-# my_study.slurm_launch(output_dir)
 
-print(f"Study name format is: {my_study.get_study_format()}")
\ No newline at end of file
+# Or run the studies on this machine, calculating the Lacey mixing indices of each study as soon as its
+# simulation finishes (see the end of the script)
+# import sys
+# sys.path.append("./lacey-files")
+# from calculate_lacey import process_study
+#
+# def post_process(folder, exit_code):
+#     if exit_code == 0:
+#         study_df = process_study(folder, max_workers=4)
+#         if study_df is not None:
+#             study_df.to_csv(os.path.join(folder, "lacey_results.csv"))
+
+
+# Studies are generated and launched only when the script is run, not when it is imported, as the spawned
+# workers of `process_study` in `post_process` import it
+if __name__ == "__main__":
+
+    # Generate study directories
+    my_study.generate_studies(output_dir)
+
+    # Alternatively, start from a coarse grid and refine it once the fitted k values of the first sweep are available
+    # my_study.generate_studies(output_dir, my_study.generate_coarse_space(levels=3))
+    # new_combinations = my_study.refine_phase_space("./post-processes/fitted_k_values.csv", n_new=20, output_dir=output_dir)
+    # my_study.generate_studies(output_dir, new_combinations)
+
+    # For larger parameter spaces, sample a space-filling design instead of the full grid
+    # my_study.generate_studies(output_dir, my_study.generate_design("sobol", n_samples=128, seed=0))
+
+    # Submit simulations as SLURM jobs
+    # my_study.slurm_launch(output_dir)
+
+    # Or submit all studies as SLURM job arrays, with at most 100 simulations running at once
+    # my_study.slurm_array_launch(output_dir, max_concurrent=100)
+
+    # Or run the studies on this machine, 8 simulations at a time with 8 MPI ranks each, post-processing each study
+    # with `post_process` above
+    # my_study.local_launch(output_dir, max_parallel=8, mpi_ranks=8,
+    #                       exit_codes_file="./lacey-files/non_zero_exit_codes.csv", on_complete=post_process)
+
+    print(f"Study name format is: {my_study.get_study_format()}")
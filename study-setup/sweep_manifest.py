@@ -0,0 +1,149 @@
+import os
+import json
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from natsort import natsorted
+
+
+MANIFEST_NAME = "sweep_manifest.json"
+
+
+def manifest_path(sweep_dir: str) -> str:
+    """
+    Returns the path of the manifest file within a sweep output directory.
+    """
+    return os.path.join(sweep_dir, MANIFEST_NAME)
+
+
+def load_manifest(sweep_dir: str) -> dict | None:
+    """
+    Reads the manifest of a sweep output directory.
+
+    Args:
+        sweep_dir (str): The directory containing the study folders.
+
+    Returns:
+        dict: The manifest, or None if the sweep has no manifest.
+    """
+    path = manifest_path(sweep_dir)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def _write_manifest(sweep_dir: str, manifest: dict) -> None:
+    """
+    Writes the manifest to a temporary file and moves it into place, so readers never see a partially written manifest.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=sweep_dir, prefix=".sweep_manifest_", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            json.dump(manifest, temp_file, indent=1)
+        os.replace(temp_path, manifest_path(sweep_dir))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def edit_manifest(sweep_dir: str, create: bool = True):
+    """
+    Context manager that locks the manifest, yields it for modification and writes it back atomically on exit. The lock
+    serialises updates from concurrent processes and threads, such as several analysis jobs finishing at once.
+
+    Args:
+        sweep_dir (str): The directory containing the study folders.
+        create (bool): Create an empty manifest if the sweep has none yet. Otherwise None is yielded and nothing is
+            written, so a sweep without a manifest keeps being discovered by globbing.
+
+    Yields:
+        dict: The manifest, or None if the sweep has none and `create` is False.
+    """
+    if not create and load_manifest(sweep_dir) is None:
+        yield None
+        return
+
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    with open(manifest_path(sweep_dir) + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest = load_manifest(sweep_dir) or {"parameters": [], "studies": {}}
+            yield manifest
+            _write_manifest(sweep_dir, manifest)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def register_studies(sweep_dir: str, param_names: list[str], studies: dict[str, dict[str, float]]) -> None:
+    """
+    Adds studies to the manifest with the status "generated". Studies already in the manifest keep their recorded state.
+    The manifest is created if the sweep has none yet, so it must then be given every study folder of the sweep.
+
+    Args:
+        sweep_dir (str): The directory containing the study folders.
+        param_names (List[str]): The names of the parameters of the sweep.
+        studies (Dict[str, Dict[str, float]]): The parameter values of each study, keyed by study folder name.
+    """
+    with edit_manifest(sweep_dir) as manifest:
+        manifest["parameters"] = param_names
+
+        for study_name, parameters in studies.items():
+            record = manifest["studies"].setdefault(study_name, {
+                "status": "generated",
+                "dumps": None,
+                "exit_code": None,
+                "analysis": None,
+            })
+            record["parameters"] = parameters
+
+
+def update_studies(sweep_dir: str, updates: dict[str, dict]) -> None:
+    """
+    Updates the recorded state of several studies at once, e.g. `{"study": {"status": "finished", "exit_code": 0}}`.
+    Studies that are not in the manifest yet are added. Does nothing if the sweep has no manifest, as a manifest listing
+    only the updated studies would hide the other study folders from `list_studies`.
+
+    Args:
+        sweep_dir (str): The directory containing the study folders.
+        updates (Dict[str, dict]): The fields to update, keyed by study folder name.
+    """
+    with edit_manifest(sweep_dir, create=False) as manifest:
+        if manifest is None:
+            return
+
+        for study_name, fields in updates.items():
+            manifest["studies"].setdefault(study_name, {}).update(fields)
+
+
+def update_study(sweep_dir: str, study_name: str, **fields) -> None:
+    """
+    Updates the recorded state of a single study, e.g. `update_study(sweep_dir, study, analysis="done")`.
+    """
+    update_studies(sweep_dir, {study_name: fields})
+
+
+def list_studies(sweep_dir: str, exclude_failed: bool = False) -> list[str] | None:
+    """
+    Lists the study folders recorded in the manifest, without walking the sweep directory.
+
+    Args:
+        sweep_dir (str): The directory containing the study folders.
+        exclude_failed (bool): Leave out studies with a recorded non-zero exit code.
+
+    Returns:
+        List[str]: The naturally sorted paths of the study folders, or None if the sweep has no manifest.
+    """
+    manifest = load_manifest(sweep_dir)
+    if manifest is None:
+        return None
+
+    studies = [
+        name for name, record in manifest["studies"].items()
+        if not (exclude_failed and record.get("exit_code") not in (None, 0))
+    ]
+
+    return [os.path.join(sweep_dir, name) for name in natsorted(studies)]